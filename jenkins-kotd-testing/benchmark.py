@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+'''
+Benchmark console_log_analyzer.py on a synthetic Jenkins KOTD console log.
+
+The log mimics a real run: reserved host, UUID, the qaset test list, then
+for each testsuite a screenlog with its test results and the submission
+block, all mixed with plenty of build/test output.
+
+Results can be saved as a baseline and compared with a later run:
+    benchmark.py --save base.json
+    benchmark.py --compare base.json
+
+With --batch N, N builds are served by a local Jenkins stand-in server and
+analyzed one by one as from a shell loop, then in batch mode.
+'''
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import console_log_analyzer as A
+
+
+class ConsoleLogGenerator(object):
+    '''
+    Generate a synthetic KOTD console log
+    '''
+    STATUSES = ['PASSED', 'PASSED', 'PASSED', 'FAILED', 'SKIPPED', 'TIMEOUT']
+    NOISE = ['+ zypper -n in -l qa_test_%s',
+            'make[2]: Entering directory `/usr/src/linux-%s/drivers/md\'',
+            '  CC [M]  drivers/md/dm-%s.o',
+            '[%s] kernel: EXT4-fs (sda2): re-mounted. Opts: (null)',
+            'Retrieving package qa_test_%s-1.0-1.1.noarch (12/140),  51.6 KiB (200.1 KiB unpacked)',
+            '%s: 100%% |=========================================| 1.2MiB/s']
+
+    # testsuites: Amount of testsuites
+    # tests: Tests per testsuite
+    # noise: Noise lines between two meaningful lines
+    # line_size: Max characters of a noise line
+    # missing: Probability of a test result to be missing
+    def __init__(self, testsuites=20, tests=200, noise=20, line_size=120, seed=0, missing=0.0):
+        self.testsuites = testsuites
+        self.tests = tests
+        self.noise = noise
+        self.line_size = line_size
+        self.missing = missing
+        self.random = random.Random(seed)
+
+    def get_params(self):
+        return {'testsuites': self.testsuites, 'tests': self.tests,
+                'noise': self.noise, 'line_size': self.line_size}
+
+    def gen_noise(self, lines):
+        for i in range(self.random.randint(0, self.noise * 2)):
+            line = self.random.choice(self.NOISE) % (self.random.randint(0, 1 << 30))
+            lines.append(line + ' ' * self.random.randint(0, self.line_size - len(line)))
+
+    def gen_testsuite(self, lines, name, index):
+        lines.append('Get file content: /var/log/qaset/runs/%s-run.screenlog' % (name))
+        self.gen_noise(lines)
+        lines.append('*' * 20 + ' Test in progress ' + '*' * 20)
+        for seq in range(1, self.tests + 1):
+            self.gen_noise(lines)
+            status = self.random.choice(self.STATUSES)
+            if self.missing and self.random.random() < self.missing:
+                continue
+            lines.append('[%4d/%d] %s_test_%d ........................ %s (%ds)' % (
+                        seq, self.tests, name, seq, status, self.random.randint(0, 600)))
+        lines.append('*' * 20 + ' Test run complete ' + '*' * 20)
+        self.gen_noise(lines)
+        lines.append('Get submission id from /var/log/qaset/submission/submission-%s.log' % (name))
+        # Test hosts don't always write UTF-8, the comment is Latin-1
+        lines.append("Submission id: 'ID %d: http://qadb.suse.de/qadb/submission.php?submission_id=%d"
+                     "&comment=r\xe9sum\xe9'" % (index, index))
+
+    def generate(self):
+        names = ['suite_%d' % (i) for i in range(self.testsuites)]
+        lines = ['Started by timer', 'reserve host kotd-%d.qa.suse.de' % (self.random.randint(0, 99)),
+                'UUID: %032x' % (self.random.getrandbits(128))]
+        for name in names:
+            self.gen_noise(lines)
+            lines.append('+ echo "%s" >> /root/qaset/list' % (name))
+        for i, name in enumerate(names):
+            self.gen_noise(lines)
+            self.gen_testsuite(lines, name, i)
+        self.gen_noise(lines)
+        lines.append('Finished: SUCCESS')
+        return '\n'.join(lines) + '\n'
+
+
+class JenkinsRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Serve /job/<job>/<build>/consoleFull and
+    /job/<job>/<build>/logText/progressiveText?start=N from server.logs.
+    As on Jenkins, consoleFull is an HTML page with the log in a <pre> and
+    a footer after it, progressiveText is the plain log.
+    '''
+    protocol_version = 'HTTP/1.1'
+    HTML_HEADER = ('<!DOCTYPE html><html><head><title>Console Output</title></head><body>\n'
+                   '<h1>Console Output</h1><pre class="console-output">')
+    HTML_FOOTER = ('</pre>\n<div id="footer">' +
+                   ''.join('<div class="footer-item" id="item-%d">Page generated</div>\n' % (i)
+                           for i in range(100)) +
+                   '<script>window.setTimeout(function() {}, 0);</script></div></body></html>\n')
+    PATH_RE = re.compile(r'^/job/([^/]+)/(\d+)/(consoleFull|logText/progressiveText\?start=(\d+))$')
+
+    def do_GET(self):
+        self.server.requests += 1
+        match = self.PATH_RE.match(self.path)
+        log = match and self.server.logs.get(int(match.group(2)))
+        if log is None:
+            self.send_error(404)
+            return
+        # Bytes of the log written so far by the build
+        end = self.server.progress.get(int(match.group(2)), len(log))
+        self.send_response(200)
+        if match.group(4) is None:
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            log = ''.join([self.HTML_HEADER, log[:end], self.HTML_FOOTER])
+        else:
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            log = log[int(match.group(4)):end]
+            self.send_header('X-Text-Size', str(end))
+            if end < len(self.server.logs[int(match.group(2))]):
+                self.send_header('X-More-Data', 'true')
+        self.server.sent += len(log)
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(log), 32 * 1024):
+                chunk = log[i:i + 32 * 1024]
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(log)))
+            self.end_headers()
+            self.wfile.write(log)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JenkinsStandIn(ThreadingMixIn, HTTPServer):
+    '''
+    Local HTTP server standing in for Jenkins, serving console logs of builds
+    '''
+    daemon_threads = True
+
+    # logs: {<build number>: <console log>}
+    def __init__(self, logs, chunked=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), JenkinsRequestHandler)
+        self.logs = logs
+        self.progress = {}  # {<running build number>: <bytes written so far>}
+        self.chunked = chunked
+        self.requests = 0
+        self.connections = 0
+        self.sent = 0       # Bytes of logs sent
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    # Clients closing their keep-alive connections aren't errors
+    def handle_error(self, request, client_address):
+        pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def best_time(func, repeat):
+    best = None
+    # Hide the "Possible missing tests" messages
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        for i in range(repeat):
+            start = time.time()
+            func()
+            t = time.time() - start
+            best = t if best is None else min(best, t)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    return best
+
+
+def benchmark(log, repeat=3):
+    results = {}
+    results['log_handler'] = best_time(lambda: A.log_handler(log), repeat)
+    # Line by line, as read from the HTTP response
+    results['log_handler_stream'] = best_time(
+            lambda: A.log_handler(A.iter_lines(StringIO(log))), repeat)
+    return results
+
+
+# Logs made mostly of screenlog test results
+def benchmark_screenlogs(testsuites, tests, repeat=3):
+    results = {}
+    generator = ConsoleLogGenerator(testsuites=testsuites, tests=tests, noise=1, missing=0.01)
+    log = generator.generate()
+    print "Screenlogs log: %.1f MB, %d lines" % (len(log) / 1024.0 / 1024.0, log.count('\n'))
+    results['screenlogs'] = best_time(lambda: A.log_handler(log), repeat)
+    # Cut in the middle of a screenlog block, as the log of an aborted build
+    truncated = log[:log.rindex('Test run complete')]
+    results['screenlogs_truncated'] = best_time(lambda: A.log_handler(truncated), repeat)
+    return results
+
+
+def benchmark_batch(generator, builds, jobs, repeat=3):
+    logs = {}
+    for number in range(1, builds + 1):
+        generator.random.seed(number)
+        logs[number] = generator.generate()
+    results = {}
+    with JenkinsStandIn(logs) as server:
+        urls = A.get_build_urls(server.url, 'kotd', '1-%d' % (builds))
+
+        # One build after the other, as from a shell loop
+        def sequential():
+            for url in urls:
+                A.log_handler(A.get_log(A.get_log_url(url)))
+
+        def batch():
+            for url, log_data, error in A.iter_builds(urls, jobs):
+                if error is not None:
+                    raise RuntimeError(error)
+
+        # The batch JSON output must load despite the Latin-1 in the logs
+        out = StringIO()
+        A.write_json(A.iter_builds(urls, jobs), out)
+        assert len(json.loads(out.getvalue())) == builds
+
+        results['batch_sequential'] = best_time(sequential, repeat)
+        connections = server.connections
+        results['batch_jobs_%d' % (jobs)] = best_time(batch, repeat)
+        print "Batch: %d builds, %d connections with urllib, %d in batch mode" % (
+                builds, connections / repeat, (server.connections - connections) / repeat)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark console_log_analyzer.py')
+    parser.add_argument('--testsuites', type=int, default=20, help='Amount of testsuites')
+    parser.add_argument('--tests', type=int, default=200, help='Tests per testsuite')
+    parser.add_argument('--noise', type=int, default=20,
+                        help='Average noise lines between meaningful lines')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Run each benchmark N times and keep the best')
+    parser.add_argument('--screenlogs', type=int, default=0, metavar='TESTS',
+                        help='Also benchmark logs of screenlogs with TESTS tests per testsuite')
+    parser.add_argument('--batch', type=int, default=0, metavar='N',
+                        help='Also benchmark the batch mode with N builds')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Processes of the batch mode')
+    parser.add_argument('--save', metavar='FILE', help='Save results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='Compare results with the baseline in FILE')
+    args = parser.parse_args()
+
+    generator = ConsoleLogGenerator(testsuites=args.testsuites, tests=args.tests, noise=args.noise)
+    log = generator.generate()
+    print "Console log: %.1f MB, %d lines" % (len(log) / 1024.0 / 1024.0, log.count('\n'))
+    results = benchmark(log, repeat=args.repeat)
+    if args.screenlogs:
+        results.update(benchmark_screenlogs(args.testsuites, args.screenlogs, repeat=args.repeat))
+    if args.batch:
+        results.update(benchmark_batch(generator, args.batch, args.jobs, repeat=args.repeat))
+    mb = len(log) / 1024.0 / 1024.0
+    print "%-20s %10s %10s" % ('Benchmark', 'Seconds', 'MB/s')
+    for name, t in sorted(results.items()):
+        print "%-20s %10.4f %10.2f" % (name, t, mb / t)
+    if args.compare:
+        with file(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline['log'] != generator.get_params():
+            print "Warning: the baseline was made with another log: %s" % (baseline['log'])
+        print
+        print "%-20s %10s %10s %8s" % ('Benchmark', 'Baseline', 'Current', 'Speedup')
+        for name, t in sorted(results.items()):
+            base = baseline['results'].get(name)
+            if base:
+                print "%-20s %10.4f %10.4f %7.2fx" % (name, base, t, base / t)
+    if args.save:
+        with file(args.save, 'w') as f:
+            json.dump({'log': generator.get_params(), 'results': results}, f, indent=2, sort_keys=True)
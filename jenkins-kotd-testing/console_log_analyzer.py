@@ -1,9 +1,50 @@
 #!/usr/bin/env python
 import argparse
+import copy
+import csv
+import glob
+import gzip
+import hashlib
+import httplib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
 import urllib
+import urlparse
+import uuid
 import re
 from string import Template
 
+# Regexps used by LogHandler, compiled once
+HOSTNAME_RE = re.compile(r'reserve host\s*([^\s]+)', re.IGNORECASE)
+UUID_RE = re.compile(r'UUID\s*:\s*([^\s]+)', re.IGNORECASE)
+TESTSUITE_RE = re.compile(r'([\w_\-]+)".*?/qaset/list', re.IGNORECASE)
+GET_SUBMISSION_RE = re.compile(r'Get submission id.*?submission-([\w_\-]+)\.log', re.IGNORECASE)
+SUBMISSION_RE = re.compile(r'Submission id.*?ID\s*(\d+)\s*:.*?(https?://.*?)\'', re.IGNORECASE)
+SCREENLOG_RE = re.compile(r'Get file content.*?([\w_\-]+)-\w+\.screenlog', re.IGNORECASE)
+TEST_START_RE = re.compile(r'\*+.*?Test in progress.*?\*+', re.IGNORECASE)
+TEST_END_RE = re.compile(r'\*+.*?Test run complete.*?\*+', re.IGNORECASE)
+TEST_RESULT_RE = re.compile(r'\[\s*(\d+)/(\d+)\s*\]\s*([\w_\-\.]+)\s+.*?([A-Z]+)\s*\(([^\s]+)\)')
+
+# Every rule of LogHandler needs one of these(lower case) strings, lines
+# without any of them are skipped without running the regexps
+RULE_KEYWORDS = ['reserve host', 'uuid', '/qaset/list', 'get submission id', 'get file content']
+
+# Longer console log lines are cut
+MAX_LINE_SIZE = 64 * 1024
+
+# Bytes read at once from a console log
+READ_BLOCK_SIZE = 64 * 1024
+
+# HTTP connections and log cache of a batch worker process, see _init_worker()
+POOL = None
+CACHE = None
+
 
 def get_log_url(url):
     url = url.strip()
@@ -11,13 +52,410 @@ def get_log_url(url):
         url = ''.join([url, 'Full'])
     return url
 
+# Url of the part of the console log of a build from the byte offset start,
+# from its console log url
+def get_progressive_url(url, start):
+    url = url.strip()
+    for suffix in ('consoleFull', 'consoleText', 'console'):
+        if url.endswith(suffix):
+            url = url[:-len(suffix)]
+            break
+    if not url.endswith('/'):
+        url = ''.join([url, '/'])
+    return '%slogText/progressiveText?start=%d' % (url, start)
+
 def get_log(url):
     f = urllib.urlopen(url)
     log = f.read()
     f.close()
     return log
 
+# Console log urls of builds of a Jenkins job
+# builds: Build numbers, e.g. "120", "100-130" or "100,105,110-115"
+def get_build_urls(jenkins, job, builds):
+    numbers = []
+    for item in builds.split(','):
+        if '-' in item:
+            first, last = item.split('-', 1)
+            numbers.extend(range(int(first), int(last) + 1))
+        else:
+            numbers.append(int(item))
+    return ['%s/job/%s/%d/console' % (jenkins.rstrip('/'), job, number) for number in numbers]
+
+class HTTPResponseFile(object):
+    '''
+    File object reading the body of a response of a ConnectionPool. The
+    connection is given back to the pool once the body is read entirely,
+    it's closed if the response is closed before.
+    '''
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.eof = False
+
+    def fill(self, size):
+        data = self.response.read(size)
+        if not data and size:
+            self.eof = True
+            self.release()
+        return data
+
+    def release(self):
+        if self.conn is not None:
+            self.pool.put(self.key, self.conn)
+            self.conn = None
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self.fill(size)
+        data = []
+        while True:
+            block = self.fill(READ_BLOCK_SIZE)
+            if not block:
+                return ''.join(data)
+            data.append(block)
+
+    def close(self):
+        if not self.eof and self.conn is not None:
+            # The rest of the body is still to be read, drop the connection
+            self.conn.close()
+            self.conn = None
+        self.response.close()
+
+class ConnectionPool(object):
+    '''
+    Keep-alive HTTP(S) connections, reused by the requests to the same host
+    '''
+    # Redirections followed by open()
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # {(<scheme>, <host:port>): [<idle connection>]}
+        self.requests = 0
+        self.connections = 0
+
+    def connect(self, key):
+        scheme, netloc = key
+        with self.lock:
+            self.connections += 1
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    # Return an idle connection if any, and whether it was reused
+    def get(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self.connect(key), False
+
+    def put(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def request(self, key, path):
+        conn, reused = self.get(key)
+        with self.lock:
+            self.requests += 1
+        try:
+            conn.request('GET', path)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+        # The server closed the idle connection, retry with a new one
+        conn = self.connect(key)
+        try:
+            conn.request('GET', path)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    # GET url, return a file object of the response body
+    def open(self, url):
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise IOError('Unsupported url: %s' % (url))
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+            conn, response = self.request(key, path)
+            if response.status == httplib.OK:
+                return HTTPResponseFile(self, key, conn, response)
+            location = response.getheader('location')
+            # Read the body, so that the connection can be reused
+            response.read()
+            self.put(key, conn)
+            if response.status not in (301, 302, 303, 307, 308) or location is None:
+                raise IOError('HTTP error %d %s: %s' % (response.status, response.reason, url))
+            url = urlparse.urljoin(url, location)
+        raise IOError('Too many redirections: %s' % (url))
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+class CachingFile(object):
+    '''
+    File object copying a console log to the cache while it's read. The copy
+    is kept if the log was read entirely and the build finished.
+    '''
+    # Bytes of the end of the log kept to find the "Finished: " line. It
+    # isn't the last line of consoleFull, an HTML page with a footer of
+    # several KB, so it's searched in the whole tail.
+    TAIL_SIZE = 64 * 1024
+    FINISHED_RE = re.compile(r'(^|\n)(<[^>\n]*>)*Finished: [A-Z_]+\b')
+
+    def __init__(self, cache, key, f):
+        self.cache = cache
+        self.key = key
+        self.f = f
+        self.tail = ''
+        self.eof = False
+        self.tmp_file = '%s.%s.tmp' % (cache.get_cache_file(key), uuid.uuid4())
+        try:
+            self.gz = gzip.open(self.tmp_file, 'wb', LogCache.COMPRESS_LEVEL)
+        except IOError, e:
+            cache.warning('Unable to write cache file %s: %s' % (self.tmp_file, e))
+            self.gz = None
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if self.gz is None:
+            return data
+        if not data:
+            if size:
+                self.eof = True
+            return data
+        try:
+            self.gz.write(data)
+        except IOError, e:
+            self.cache.warning('Unable to write cache file %s: %s' % (self.tmp_file, e))
+            self.drop()
+            return data
+        if len(data) >= self.TAIL_SIZE:
+            self.tail = data[-self.TAIL_SIZE:]
+        else:
+            self.tail = (self.tail + data)[-self.TAIL_SIZE:]
+        return data
+
+    def drop(self):
+        try:
+            self.gz.close()
+        except IOError, e:
+            pass
+        self.gz = None
+        self.cache.remove(self.tmp_file)
+
+    def close(self):
+        self.f.close()
+        if self.gz is None:
+            return
+        if not self.eof or self.FINISHED_RE.search(self.tail) is None:
+            # The log may still grow
+            self.drop()
+            return
+        try:
+            self.gz.close()
+        except IOError, e:
+            self.cache.warning('Unable to write cache file %s: %s' % (self.tmp_file, e))
+            self.gz = None
+            self.cache.remove(self.tmp_file)
+            return
+        self.gz = None
+        self.cache.put(self.key, self.tmp_file)
+
+class LogCache(object):
+    '''
+    On-disk cache of the console logs of finished builds.
+
+    Each log is gzipped to <path>/<sha1 of url>.log.gz. Logs of builds in
+    progress aren't cached, so they're fetched again. The least recently used
+    logs are removed when the cache grows over max_size bytes.
+    '''
+    DEFAULT_DIR     = '~/.cache/console_log_analyzer'
+    MAX_SIZE        = 1024 * 1024 * 1024
+    SUFFIX          = '.log.gz'
+    COMPRESS_LEVEL  = 6
+    STATS           = ['hits', 'misses', 'stores', 'evictions']
+
+    def __init__(self, path=DEFAULT_DIR, max_size=MAX_SIZE):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.stats = dict((name, 0) for name in self.STATS)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0755)
+
+    def warning(self, message):
+        print >> sys.stderr, 'Warning: %s' % (message)
+
+    def key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def get_cache_file(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    # Open the cached log of url, or fetch it with pool and cache it
+    def open(self, url, pool):
+        key = self.key(url)
+        cache_file = self.get_cache_file(key)
+        try:
+            f = gzip.open(cache_file, 'rb')
+        except IOError, e:
+            self.stats['misses'] += 1
+            return CachingFile(self, key, pool.open(url))
+        self.stats['hits'] += 1
+        # Update mtime for LRU eviction
+        try:
+            os.utime(cache_file, None)
+        except OSError, e:
+            pass
+        return f
+
+    # Move the gzipped log tmp_file into the cache
+    def put(self, key, tmp_file):
+        cache_file = self.get_cache_file(key)
+        try:
+            os.rename(tmp_file, cache_file)
+        except OSError, e:
+            self.warning('Unable to write cache file %s: %s' % (cache_file, e))
+            self.remove(tmp_file)
+            return
+        self.stats['stores'] += 1
+        self.evict()
+
+    def remove(self, cache_file):
+        try:
+            os.remove(cache_file)
+        except OSError, e:
+            pass
+
+    # Remove the least recently used logs until the cache fits max_size
+    def evict(self):
+        entries = []
+        total = 0
+        for cache_file in glob.glob(os.path.join(self.path, '*' + self.SUFFIX)):
+            try:
+                st = os.stat(cache_file)
+            except OSError, e:
+                continue
+            entries.append((st.st_mtime, st.st_size, cache_file))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, cache_file in entries:
+            if total <= self.max_size:
+                break
+            self.remove(cache_file)
+            self.stats['evictions'] += 1
+            total -= size
+
+    # Return the stats and reset them
+    def take_stats(self):
+        stats = self.stats
+        self.stats = dict((name, 0) for name in self.STATS)
+        return stats
+
+    def merge_stats(self, stats):
+        for name, value in stats.items():
+            self.stats[name] += value
+
+    def format_stats(self):
+        return 'Cache: %d hits, %d misses, %d stored, %d evicted' % tuple(
+                self.stats[name] for name in self.STATS)
+
+# Open a console log url or a local file
+# pool: ConnectionPool used to fetch the url. urllib isn't used, as its
+# responses are unbuffered and reading them line by line is very slow.
+# cache: LogCache of the logs of finished builds, or None
+def open_log(url, pool=None, cache=None):
+    if os.path.isfile(url):
+        return open(url, 'rb')
+    if pool is None:
+        pool = ConnectionPool()
+    if cache is not None:
+        return cache.open(get_log_url(url), pool)
+    return pool.open(get_log_url(url))
+
+class LineSplitter(object):
+    '''
+    Split the blocks of a console log read one after the other into lines,
+    the same way as str.splitlines(). The last line of a block is kept until
+    its end is read. Lines longer than max_line_size are cut, so a log
+    without newlines doesn't end up in memory.
+    '''
+    def __init__(self, max_line_size=MAX_LINE_SIZE):
+        self.max_line_size = max_line_size
+        self.rest = ''
+        self.cut = False    # The end of a cut line is to be dropped
+
+    # Return the lines ended in block
+    def split(self, block):
+        max_line_size = self.max_line_size
+        data = self.rest + block
+        lines = data.splitlines()
+        # A '\r' may be followed by '\n' in the next block
+        if data.endswith('\n'):
+            self.rest = ''
+        elif data.endswith('\r'):
+            self.rest = lines.pop() + '\r'
+        else:
+            self.rest = lines.pop()
+        if self.cut and lines:
+            lines.pop(0)
+            self.cut = False
+        lines = [line[:max_line_size] for line in lines]
+        rest = self.rest
+        if len(rest) > max_line_size and len(rest.rstrip('\r')) > max_line_size:
+            if not self.cut:
+                lines.append(rest[:max_line_size])
+                self.cut = True
+            self.rest = rest[-1:] if rest.endswith('\r') else ''
+        return lines
+
+    # The log ended, return its last line if any
+    def finish(self):
+        lines = []
+        if self.rest and not self.cut:
+            lines.append(self.rest.rstrip('\r')[:self.max_line_size])
+        self.rest = ''
+        self.cut = False
+        return lines
+
+# Yield the lines of a file object(e.g. an HTTP response) as they're read
+def iter_lines(f, max_line_size=MAX_LINE_SIZE):
+    splitter = LineSplitter(max_line_size)
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        for line in splitter.split(block):
+            yield line
+    for line in splitter.finish():
+        yield line
+
+# Statuses found in the logs, as get_correct_status() returns them
+STATUSES = {}
+MAX_STATUSES = 1024
+
 def get_correct_status(status):
+    value = STATUSES.get(status)
+    if value is not None:
+        return value
     rules = {'LED': 'FAILED',
         'SED': 'PASSED',
         'PED': 'SKIPPED',
@@ -29,11 +467,135 @@ def get_correct_status(status):
         'SS': 'PASSED',}
     for key, value in rules.items():
         if key in status:
+            if len(STATUSES) < MAX_STATUSES:
+                STATUSES[status] = value
             return value
     raise ValueError('Invalid type: %s' % (status))
 
-def log_handler(log):
-    def testsuites_handler(match, value, lines, index):
+class TestBitset(object):
+    '''
+    Bits of the tests of a screenlog block whose result was seen, one bit
+    per test
+    '''
+    def __init__(self, total):
+        self.total = total
+        self.bits = bytearray((total + 7) >> 3)
+
+    # Results out of range are ignored
+    def add(self, seq):
+        if 0 < seq <= self.total:
+            i = seq - 1
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    # Return the sequence numbers without result
+    def missing(self):
+        missing = []
+        for byte_index, byte in enumerate(self.bits):
+            if byte == 0xff:
+                continue
+            first = byte_index << 3
+            for i in range(first, min(first + 8, self.total)):
+                if not byte & (1 << (i & 7)):
+                    missing.append(i + 1)
+        return missing
+
+
+class ScreenlogState(object):
+    '''
+    Collect the test results of a screenlog, from its "Get file content"
+    line to the next "Get submission id" line. Each block of results between
+    "Test in progress" and "Test run complete" is a list of tests.
+    '''
+    def __init__(self, name, screenlogs):
+        self.name = name
+        self.screenlogs = screenlogs    # Blocks are appended to it
+        self.screenlog = None           # Block in progress
+        self.seq = 0
+        self.total = 0
+        self.test = None
+        self.bitset = None
+
+    # Return False once the screenlog is over
+    def feed(self, line):
+        if self.screenlog is None:
+            if ('get submission id' in line.lower() and
+                    GET_SUBMISSION_RE.search(line) is not None):
+                return False
+            if '*' not in line or TEST_START_RE.search(line) is None:
+                return True
+            self.screenlog = []
+            self.seq = 0
+            self.total = 0
+            self.test = None
+            self.bitset = None
+        # The "Test in progress" line too may hold a result
+        if '*' in line and TEST_END_RE.search(line) is not None:
+            self.end_block()
+            return True
+        match = None
+        if '[' in line:
+            match = TEST_RESULT_RE.search(line)
+        if match is not None:
+            self.seq = int(match.group(1))
+            self.total = int(match.group(2))
+            if self.bitset is None:
+                self.bitset = TestBitset(self.total)
+            self.bitset.add(self.seq)
+            self.test = match.group(3)
+            status = get_correct_status(match.group(4))
+            duration = match.group(5)
+            self.screenlog.append({'test': self.test, 'seq': self.seq, 'total': self.total,
+                                    'status': status, 'duration': duration})
+        return True
+
+    def end_block(self):
+        # Check if all tests status are available
+        if self.bitset is not None:
+            missing = self.bitset.missing()
+            if len(missing) != 0:
+                print >> sys.stderr, "Possible missing tests: %s\nSearch for: %d/%d] %s" % (', '.join(map(str, missing)), self.seq, self.total, self.test)
+        self.screenlogs.append(self.screenlog)
+        self.screenlog = None
+        self.bitset = None
+
+    # The screenlog ended without "Get submission id"(the next one started
+    # or the log ended), keep the results of the block in progress
+    def finish(self):
+        if self.screenlog is not None:
+            self.end_block()
+
+
+class LogHandler(object):
+    '''
+    Parse a console log line by line, so it can be read as a stream and
+    doesn't have to fit in memory.
+
+    The data following a matched line(submission id, screenlog tests) is
+    collected by states fed with the next lines.
+    '''
+    # Lines after "Get submission id" searched for the submission id
+    SUBMISSION_LINES = 9
+
+    def __init__(self):
+        # (name, regexp object, handler)
+        self.rules = [
+            ('hostname', HOSTNAME_RE),
+            ('uuid', UUID_RE),
+            ('testsuites', TESTSUITE_RE, self.testsuites_handler),
+            ('submissions', GET_SUBMISSION_RE, self.submission_handler),
+            ('screenlog', SCREENLOG_RE, self.screenlog_handler),
+        ]
+        self.results = {
+            'hostname': None,
+            'uuid': None,
+            'testsuites': [],
+            'submissions': {},
+            'screenlog': {},
+        }
+        self.submissions = []   # [[<testsuite name>, <lines left>]] waiting for the id
+        self.screenlog = None   # ScreenlogState of the screenlog in progress
+
+    def testsuites_handler(self, match, value):
         res = match.group(1)
         if res == '_reboot_off':
             return value
@@ -41,90 +603,53 @@ def log_handler(log):
         value.add(res)
         return list(value)
 
-    def submission_handler(match, value, lines, index):
-        name = match.group(1)
-        for i in range(index + 1, index + 10):
-            line = lines[i]
-            match = re.search(r'Submission id.*?ID\s*(\d+)\s*:.*?(https?://.*?)\'',
-                                line,
-                                re.IGNORECASE)
-            if match is not None:
-                value[name] = {'id': match.group(1), 'url': match.group(2)}
-                return value
-        value[name] = {}
+    def submission_handler(self, match, value):
+        self.submissions.append([match.group(1), self.SUBMISSION_LINES])
         return value
 
-    def screenlog_handler(match, value, lines, index):
+    def screenlog_handler(self, match, value):
         name = match.group(1)
         if not value.has_key(name):
             value[name] = []
-        index += 1
-        line = lines[index]
-        while re.search(r'Get submission id.*?submission-([\w_\-]+)\.log',
-                        line,
-                        re.IGNORECASE) is None:
-            if re.search(r'\*+.*?Test in progress.*?\*+',
-                        line, re.IGNORECASE) is not None:
-                screenlog = []
-                seq = 0
-                total = 0
-                test = None
-                bitmap = None
-                while re.search(r'\*+.*?Test run complete.*?\*+',
-                                line, re.IGNORECASE) is None:
-                    match = re.search(r'\[\s*(\d+)/(\d+)\s*\]\s*([\w_\-\.]+)\s+.*?([A-Z]+)\s*\(([^\s]+)\)',
-                                        line)
-                    if match is not None:
-                        seq = int(match.group(1))
-                        total = int(match.group(2))
-                        if bitmap is None:
-                            bitmap = [0 for i in range(total)]
-                        bitmap[seq - 1] = 1
-                        test = match.group(3)
-                        status = get_correct_status(match.group(4))
-                        duration = match.group(5)
-                        screenlog.append({'test': test, 'seq': seq, 'total': total, 'status': status, 'duration': duration})
-                    index += 1
-                    line = lines[index]
-                # Check if all tests status are available
-                if bitmap is not None:
-                    missing = []
-                    for i in range(len(bitmap)):
-                        if bitmap[i] == 0:
-                            missing.append(i + 1)
-                    if len(missing) != 0:
-                        print "Possible missing tests: %s\nSearch for: %d/%d] %s" % (', '.join(map(str, missing)), seq, total, test)
-                value[name].append(screenlog)
-            index += 1
-            line = lines[index]
+        # A screenlog ends where the next one starts, so a missing "Get
+        # submission id" line doesn't make the lines be parsed twice
+        if self.screenlog is not None:
+            self.screenlog.finish()
+        self.screenlog = ScreenlogState(name, value[name])
         return value
 
-    # (name, regexp object, handler)
-    rules = [
-        ('hostname', r'reserve host\s*([^\s]+)'),
-        ('uuid', r'UUID\s*:\s*([^\s]+)'),
-        ('testsuites', r'([\w_\-]+)".*?/qaset/list', testsuites_handler),
-        ('submissions', r'Get submission id.*?submission-([\w_\-]+)\.log', submission_handler),
-        ('screenlog', r'Get file content.*?([\w_\-]+)-\w+\.screenlog', screenlog_handler),
-    ]
-
-    results = {
-        'hostname': None,
-        'uuid': None,
-        'testsuites': [],
-        'submissions': {},
-        'screenlog': {},
-    }
-    lines = log.splitlines()
-    for i in range(len(lines)):
-        line = lines[i]
-        for rule in rules:
+    # Look for the submission ids waited for
+    def feed_submissions(self, line):
+        match = SUBMISSION_RE.search(line)
+        waiting = []
+        for name, left in self.submissions:
+            if match is not None:
+                self.results['submissions'][name] = {'id': match.group(1), 'url': match.group(2)}
+            elif left <= 1:
+                self.results['submissions'][name] = {}
+            else:
+                waiting.append([name, left - 1])
+        self.submissions = waiting
+
+    def feed(self, line):
+        # States started by the previous lines
+        if self.submissions:
+            self.feed_submissions(line)
+        if self.screenlog is not None and not self.screenlog.feed(line):
+            self.screenlog = None
+        lowered = line.lower()
+        for keyword in RULE_KEYWORDS:
+            if keyword in lowered:
+                break
+        else:
+            return
+        for rule in self.rules:
             name = rule[0]
-            match = re.search(rule[1], line, re.IGNORECASE)
+            match = rule[1].search(line)
             if match is not None:
                 # Call handler if any
                 if len(rule) == 3:
-                    results[name] = rule[2](match, results.get(name), lines, i)
+                    self.results[name] = rule[2](match, self.results.get(name))
                     continue
                 # Match string using regex
                 if match.lastindex is None:
@@ -132,10 +657,39 @@ def log_handler(log):
                 else:
                     value = match.group(match.lastindex)
                 # Store result into dict
-                results[name] = value
-    return results
+                self.results[name] = value
 
-def report(log_data):
+    # The log ended, return the results
+    def finish(self):
+        for name, left in self.submissions:
+            self.results['submissions'][name] = {}
+        self.submissions = []
+        if self.screenlog is not None:
+            self.screenlog.finish()
+            self.screenlog = None
+        return self.results
+
+    # Return the results of the lines fed so far, as if the log ended here,
+    # without changing the state, so the parsing can go on
+    def snapshot(self):
+        results = copy.deepcopy(self.results)
+        for name, left in self.submissions:
+            results['submissions'][name] = {}
+        state = self.screenlog
+        if state is not None and state.screenlog is not None:
+            results['screenlog'][state.name].append(list(state.screenlog))
+        return results
+
+# log: The console log, as a string or an iterable of lines(see iter_lines())
+def log_handler(log):
+    if isinstance(log, basestring):
+        log = log.splitlines()
+    handler = LogHandler()
+    for line in log:
+        handler.feed(line)
+    return handler.finish()
+
+def format_report(log_data):
     s = Template('''=============test report==============
 test machine: $hostname
 uuid: $uuid
@@ -200,19 +754,424 @@ $submission_status
         'failed_tests': '\n'.join(failed_report),
     }
 
+    return s.substitute(report_data)
+
+def report(log_data):
+    print format_report(log_data)
 
-    print s.substitute(report_data)
+# Analyze the console log of a build while it's running, reading only the
+# bytes added since the previous poll. The report is printed each time the
+# log grows. Return the log data once the build finished or on Ctrl-C.
+# Network errors are retried, from the first byte not parsed yet.
+# interval: Seconds between two polls
+# live: Print the report each time the log grows
+def follow_log(url, pool=None, interval=10, live=True):
+    if pool is None:
+        pool = ConnectionPool()
+    handler = LogHandler()
+    splitter = LineSplitter()
+    start = 0
+    try:
+        while True:
+            # Bytes parsed so far, where to start again after an error
+            offset = start
+            try:
+                f = pool.open(get_progressive_url(url, start))
+                try:
+                    while True:
+                        block = f.read(READ_BLOCK_SIZE)
+                        if not block:
+                            break
+                        offset += len(block)
+                        for line in splitter.split(block):
+                            handler.feed(line)
+                    size = int(f.getheader('X-Text-Size', offset))
+                    more = f.getheader('X-More-Data', 'false').lower() == 'true'
+                finally:
+                    f.close()
+            except (IOError, httplib.HTTPException), e:
+                print >> sys.stderr, 'Warning: %s, retrying in %ss: %s' % (e.__class__.__name__, interval, e)
+                start = offset
+                time.sleep(interval)
+                continue
+            if not more:
+                break
+            if size != start:
+                start = size
+                if live:
+                    print '%s, %d bytes of log read, build in progress' % (time.strftime('%H:%M:%S'), start)
+                    report(handler.snapshot())
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print >> sys.stderr, 'Interrupted, the build may still be in progress'
+    for line in splitter.finish():
+        handler.feed(line)
+    return handler.finish()
+
+# Analyze the console log of a build, return (url, log data, error)
+def analyze_build(url, pool=None, cache=None):
+    try:
+        f = open_log(url, pool, cache)
+        try:
+            return url, log_handler(iter_lines(f)), None
+        finally:
+            f.close()
+    except Exception, e:
+        return url, None, '%s: %s' % (e.__class__.__name__, e)
+
+# cache: (path, max size) of the LogCache, or None
+def _init_worker(timeout, cache):
+    global POOL, CACHE
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    POOL = ConnectionPool(timeout)
+    if cache is not None:
+        CACHE = LogCache(*cache)
+
+def _analyze_build_worker(url):
+    result = analyze_build(url, POOL, CACHE)
+    return result, CACHE and CACHE.take_stats()
+
+# Analyze the builds with jobs processes, yield (url, log data, error) in
+# the order of urls
+# cache: LogCache, it gets the cache stats of all the processes
+def iter_builds(urls, jobs=4, timeout=60, cache=None):
+    if jobs <= 1 or len(urls) <= 1:
+        pool = ConnectionPool(timeout)
+        try:
+            for url in urls:
+                yield analyze_build(url, pool, cache)
+        finally:
+            pool.close()
+        return
+    if cache is not None:
+        args = (timeout, (cache.path, cache.max_size))
+    else:
+        args = (timeout, None)
+    workers = multiprocessing.Pool(min(jobs, len(urls)), _init_worker, args)
+    try:
+        for result, stats in workers.imap(_analyze_build_worker, urls):
+            if stats:
+                cache.merge_stats(stats)
+            yield result
+        workers.close()
+    except:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+
+def count_failed(log_data):
+    count = 0
+    for screenlogs in log_data['screenlog'].values():
+        for screenlog in screenlogs:
+            for item in screenlog:
+                if item['status'] == 'FAILED':
+                    count += 1
+    return count
+
+# Print the report of each build, then a summary of all of them
+# Return the amount of builds which couldn't be analyzed
+def batch_report(results):
+    summary = ["Build".ljust(60), "Host".ljust(25), "Testsuites".ljust(12),
+               "Failed".ljust(8), "No submission\n"]
+    errors = 0
+    for url, log_data, error in results:
+        print '#' * 60
+        print 'Build: %s' % (url)
+        if error is not None:
+            errors += 1
+            print 'Error: %s\n' % (error)
+            summary.append('%s%s\n' % (url.ljust(60), 'ERROR: %s' % (error)))
+            continue
+        report(log_data)
+        missing = [name for name in log_data['testsuites']
+                    if not log_data['submissions'].get(name)]
+        summary.append(url.ljust(60))
+        summary.append(str(log_data['hostname']).ljust(25))
+        summary.append(str(len(log_data['testsuites'])).ljust(12))
+        summary.append(str(count_failed(log_data)).ljust(8))
+        summary.append('%d\n' % (len(missing)))
+    print '=' * 24 + 'summary' + '=' * 24
+    print ''.join(summary)
+    return errors
+
+# Decode the byte strings read from a log, which need not be UTF-8, so that
+# json can dump them. Undecodable bytes are replaced with U+FFFD
+def decode_strings(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((decode_strings(key), decode_strings(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [decode_strings(item) for item in value]
+    return value
+
+# Return the data of a build as dumped by write_json()
+def build_to_json(url, log_data, error):
+    data = {'url': url}
+    if error is not None:
+        data['error'] = error
+    else:
+        data.update(log_data)
+    return decode_strings(data)
+
+# Write the builds as JSON, a list of builds or only one if single
+# Return the amount of builds which couldn't be analyzed
+def write_json(results, f, single=False):
+    errors = 0
+    if single:
+        url, log_data, error = list(results)[0]
+        json.dump(build_to_json(url, log_data, error), f, indent=2, sort_keys=True)
+        f.write('\n')
+        return int(error is not None)
+    # Builds are written as soon as analyzed, the list is closed even if
+    # interrupted so that the builds already written can still be loaded
+    f.write('[')
+    try:
+        for i, (url, log_data, error) in enumerate(results):
+            if error is not None:
+                errors += 1
+            data = json.dumps(build_to_json(url, log_data, error), sort_keys=True)
+            f.write((',\n' if i else '\n') + data)
+            f.flush()
+    finally:
+        f.write('\n]\n')
+    return errors
+
+CSV_COLUMNS = ['url', 'hostname', 'uuid', 'testsuite', 'submission_id', 'submission_url',
+               'block', 'seq', 'total', 'test', 'status', 'duration', 'error']
+
+# Write one row per test result, or per testsuite without results
+# Return the amount of builds which couldn't be analyzed
+def write_csv(results, f):
+    errors = 0
+    writer = csv.writer(f)
+    writer.writerow(CSV_COLUMNS)
+    for url, log_data, error in results:
+        if error is not None:
+            errors += 1
+            writer.writerow([url] + [''] * (len(CSV_COLUMNS) - 2) + [error])
+            continue
+        # Testsuites with results but not in the test list too
+        names = list(log_data['testsuites'])
+        names.extend(sorted(set(log_data['screenlog']) - set(names)))
+        for name in names:
+            submission = log_data['submissions'].get(name, {})
+            row = [url, log_data['hostname'], log_data['uuid'], name,
+                    submission.get('id'), submission.get('url')]
+            screenlogs = log_data['screenlog'].get(name)
+            if not any(screenlogs or []):
+                writer.writerow(row + [''] * 6 + [''])
+                continue
+            for block, screenlog in enumerate(screenlogs):
+                for item in screenlog:
+                    writer.writerow(row + [block, item['seq'], item['total'], item['test'],
+                                           item['status'], item['duration'], ''])
+        f.flush()
+    return errors
+
+class FailureMatrix(object):
+    '''
+    Status of the tests(rows) in many builds(columns).
+
+    Each build is a column of one status character per test row, so that
+    the matrix is transposed with zip() and the results of a test are
+    counted with str.count() rather than in Python loops, with hundreds of
+    builds of thousands of tests.
+    '''
+    NOT_RUN = ' '
+    # Status characters, a test run several times in a build keeps the
+    # status coming first
+    STATUSES = [('FAILED', 'F'), ('TIMEOUT', 'T'), ('PASSED', '.'), ('SKIPPED', 's')]
+    # Results other than passed or failed(FAILED/TIMEOUT), ignored by flips
+    NOT_PASS_FAIL_RE = re.compile(r'[^.FT]+')
+    # Runs of passed or failed results
+    FLIP_RE = re.compile(r'\.+|[FT]+')
+
+    def __init__(self):
+        self.builds = []
+        self.columns = []
+        self.tests = []     # [(<testsuite>, <test>)] of the rows
+        self.rows = {}      # {(<testsuite>, <test>): <row>}
+        self.codes = dict((status, ord(char)) for status, char in self.STATUSES)
+        self.rank = dict((ord(char), i) for i, (status, char) in enumerate(self.STATUSES))
+        self.rank[ord(self.NOT_RUN)] = len(self.STATUSES)
+
+    def add(self, url, log_data):
+        not_run = ord(self.NOT_RUN)
+        rows, tests, codes, rank = self.rows, self.tests, self.codes, self.rank
+        column = bytearray(self.NOT_RUN * len(tests))
+        for testsuite, screenlogs in log_data['screenlog'].items():
+            for screenlog in screenlogs:
+                for item in screenlog:
+                    key = (testsuite, item['test'])
+                    row = rows.get(key)
+                    if row is None:
+                        row = len(tests)
+                        rows[key] = row
+                        tests.append(key)
+                        column.append(not_run)
+                    code = codes.get(item['status'])
+                    if code is not None and rank[code] < rank[column[row]]:
+                        column[row] = code
+        self.builds.append(url)
+        self.columns.append(column)
+
+    # Return the status characters of each test in the builds
+    def get_rows(self):
+        if not self.columns:
+            return []
+        size = len(self.tests)
+        columns = [str(column) + self.NOT_RUN * (size - len(column)) for column in self.columns]
+        return [''.join(row) for row in zip(*columns)]
+
+    # Return the counts of a row of get_rows()
+    def count(self, row):
+        failed = row.count('F')
+        timeout = row.count('T')
+        passed = row.count('.')
+        skipped = row.count('s')
+        runs = failed + timeout + passed + skipped
+        # Builds where the test didn't run or was skipped don't split a run
+        results = self.NOT_PASS_FAIL_RE.sub('', row)
+        flips = max(len(self.FLIP_RE.findall(results)) - 1, 0)
+        return {'runs': runs, 'passed': passed, 'failed': failed, 'timeout': timeout,
+                'skipped': skipped, 'flips': flips, 'flaky': passed != 0 and failed + timeout != 0}
+
+    # Return [(testsuite, test, row, counts)] of the tests, the most failed
+    # first. all_tests: Tests which never failed too
+    def get_tests(self, all_tests=False):
+        tests = []
+        for (testsuite, test), row in zip(self.tests, self.get_rows()):
+            counts = self.count(row)
+            if all_tests or counts['failed'] or counts['timeout']:
+                tests.append((testsuite, test, row, counts))
+        tests.sort(key=lambda item: (-item[3]['failed'] - item[3]['timeout'], -item[3]['flips'],
+                                     item[0], item[1]))
+        return tests
+
+    def write_text(self, f, all_tests=False):
+        tests = self.get_tests(all_tests)
+        f.write('=============failure matrix==============\n')
+        for i, url in enumerate(self.builds):
+            f.write('%4d %s\n' % (i + 1, url))
+        legend = ['%s %s' % (char, status) for status, char in self.STATUSES]
+        legend.append("'%s' not run" % (self.NOT_RUN))
+        f.write('\n%s\n\n' % (', '.join(legend)))
+        width = max(len(self.builds), len('Builds'))
+        f.write('%s  %s %s %s\n' % ('Builds'.ljust(width), 'Failed'.rjust(9), 'Flips'.rjust(5), 'Test'))
+        for testsuite, test, row, counts in tests:
+            failed = '%d/%d' % (counts['failed'] + counts['timeout'], counts['runs'])
+            f.write('%s  %s %s %s/%s\n' % (row.ljust(width), failed.rjust(9), str(counts['flips']).rjust(5),
+                                           testsuite, test))
+        flaky = len([item for item in tests if item[3]['flaky']])
+        f.write('\n%d tests failed at least once, %d of them are flaky\n' % (
+                len([item for item in tests if item[3]['failed'] or item[3]['timeout']]), flaky))
+
+    def write_json(self, f, all_tests=False):
+        tests = []
+        for testsuite, test, row, counts in self.get_tests(all_tests):
+            data = {'testsuite': testsuite, 'test': test, 'results': row}
+            data.update(counts)
+            tests.append(data)
+        statuses = dict((char, status) for status, char in self.STATUSES)
+        statuses[self.NOT_RUN] = None
+        json.dump(decode_strings({'builds': self.builds, 'statuses': statuses, 'tests': tests}),
+                  f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def write_csv(self, f, all_tests=False):
+        columns = ['testsuite', 'test', 'runs', 'passed', 'failed', 'timeout', 'skipped', 'flips', 'flaky']
+        statuses = dict((char, status) for status, char in self.STATUSES)
+        statuses[self.NOT_RUN] = ''
+        writer = csv.writer(f)
+        writer.writerow(columns + self.builds)
+        for testsuite, test, row, counts in self.get_tests(all_tests):
+            writer.writerow([testsuite, test] + [int(counts[name]) for name in columns[2:]] +
+                            [statuses[char] for char in row])
 
 def main():
     parser = argparse.ArgumentParser(description = 'Analyze jenkins kotd console log')
-    parser.add_argument('url', metavar='URL', type=str)
+    parser.add_argument('url', metavar='URL', type=str, nargs='*',
+                        help='Jenkins console log url, or a local console log file')
+    parser.add_argument('--jenkins', metavar='URL', help='Jenkins url of --job')
+    parser.add_argument('--job', help='Analyze builds of the Jenkins job JOB')
+    parser.add_argument('--builds', help='Build numbers of --job, e.g. 100-130 or 100,105,110-115')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Analyze several builds with N processes. Default: 4')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='HTTP timeout in seconds. Default: 60')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='Follow the console log of a running build, report it as it grows')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='Seconds between two polls of --follow. Default: 10')
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                        help='Output format. Default: text')
+    parser.add_argument('-m', '--matrix', action='store_true',
+                        help='Print the failure matrix of the tests in the builds instead of their reports')
+    parser.add_argument('--all-tests', action='store_true',
+                        help='Include the tests which never failed in --matrix')
+    parser.add_argument('-c', '--cache', metavar='DIR',
+                        help='Cache the console logs of finished builds in DIR, e.g. %s' % (
+                            LogCache.DEFAULT_DIR))
+    parser.add_argument('--cache-size', type=int, default=LogCache.MAX_SIZE / 1024 / 1024,
+                        help='Max cache size in MB. Default: %(default)s')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='Print the cache hits and misses to stderr')
     args = parser.parse_args()
 
-    url = get_log_url(args.url)
-    log = get_log(url)
-    log_data = log_handler(log)
+    urls = list(args.url)
+    if args.job or args.builds:
+        if not (args.jenkins and args.job and args.builds):
+            parser.error('--job requires --jenkins and --builds')
+        urls.extend(get_build_urls(args.jenkins, args.job, args.builds))
+    if not urls:
+        parser.error('no console log url')
+    if args.follow and (len(urls) != 1 or os.path.isfile(urls[0])):
+        parser.error('--follow requires the url of one build')
+
+    cache = None
+    if args.cache:
+        cache = LogCache(args.cache, args.cache_size * 1024 * 1024)
+
+    # A single build is reported as is, errors aren't caught
+    single = len(urls) == 1
+    if args.follow:
+        log_data = follow_log(urls[0], ConnectionPool(args.timeout), args.interval,
+                              live=args.format == 'text' and not args.matrix)
+        results = [(urls[0], log_data, None)]
+    elif single:
+        f = open_log(urls[0], ConnectionPool(args.timeout), cache)
+        try:
+            log_data = log_handler(iter_lines(f))
+        finally:
+            f.close()
+        results = [(urls[0], log_data, None)]
+    else:
+        results = iter_builds(urls, args.jobs, args.timeout, cache)
 
-    report(log_data)
+    errors = 0
+    if args.matrix:
+        matrix = FailureMatrix()
+        for url, log_data, error in results:
+            if error is not None:
+                errors += 1
+                print >> sys.stderr, 'Error: %s: %s' % (url, error)
+                continue
+            matrix.add(url, log_data)
+        getattr(matrix, 'write_%s' % (args.format))(sys.stdout, args.all_tests)
+    elif args.format == 'json':
+        errors = write_json(results, sys.stdout, single)
+    elif args.format == 'csv':
+        errors = write_csv(results, sys.stdout)
+    elif single:
+        report(results[0][1])
+    else:
+        errors = batch_report(results)
+    if cache is not None and args.cache_stats:
+        print >> sys.stderr, cache.format_stats()
+    if errors:
+        sys.exit(1)
 
 #    #for testsuite, screenlogs in data['screenlog'].items():
 #        for screenlog in screenlogs:
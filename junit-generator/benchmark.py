@@ -0,0 +1,420 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+'''
+Benchmark junit_xml_gen.py on a synthetic qaset log tree.
+
+Each stage of the conversion(discovery, extraction, testcase parsing,
+submission merge, xml build and serialization with ElementTree, or direct
+writing with JunitWriter) is timed separately, then
+whole conversions are run with different options. Every run happens in a
+child process so that its peak memory can be reported.
+
+Results can be saved as a baseline and compared with a later run:
+    benchmark.py --save base.json
+    benchmark.py --compare base.json
+'''
+from contextlib import contextmanager
+import cStringIO
+import fnmatch
+import glob
+import json
+import logging
+import multiprocessing
+from optparse import OptionParser
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import junit_xml_gen as J
+
+
+class CorpusGenerator(object):
+    '''
+    Generate a synthetic qaset log tree:
+
+        <root>/log/qa_<suite>-<timestamp>/          log dirs
+        <root>/log/<suite>-bench.tar.<compression>  tarballs of log dirs
+        <root>/submission/submission-<suite>.log    submission logs
+    '''
+    COMPRESSIONS = ['bz2', 'gz', 'xz']
+    RESULTS = [(0, 1, 1, 3, 0, 0),      # success
+               (1, 0, 1, 2, 0, 0),      # failure
+               (0, 0, 1, 1, 1, 0),      # error
+               (0, 0, 1, 0, 0, 1)]      # skipped
+
+    # dirs: Amount of plain log dirs
+    # tarballs: Amount of tarballs, each holding suites_per_tarball log dirs
+    # testcases: Testcases per testsuite
+    # lines: Max lines per testcase log(the amount is random)
+    # line_size: Characters per log line
+    # non_utf8: Ratio of log lines containing latin-1 characters
+    # compressions: Tarball compressions, used in turn
+    def __init__(self, root, dirs=4, tarballs=8, suites_per_tarball=1,
+                testcases=50, lines=200, line_size=80, non_utf8=0.01,
+                compressions=COMPRESSIONS, seed=0):
+        self.root = J.expand_path(root)
+        self.log_dir = os.path.join(self.root, 'log')
+        self.submission_dir = os.path.join(self.root, 'submission')
+        self.dirs = dirs
+        self.tarballs = tarballs
+        self.suites_per_tarball = suites_per_tarball
+        self.testcases = testcases
+        self.lines = lines
+        self.line_size = line_size
+        self.non_utf8 = non_utf8
+        self.compressions = compressions
+        self.random = random.Random(seed)
+        self.suite_count = 0
+
+    def get_params(self):
+        return {'dirs'              : self.dirs,
+                'tarballs'          : self.tarballs,
+                'suites_per_tarball': self.suites_per_tarball,
+                'testcases'         : self.testcases,
+                'lines'             : self.lines,
+                'line_size'         : self.line_size,
+                'non_utf8'          : self.non_utf8,
+                'compressions'      : self.compressions}
+
+    def gen_line(self, num):
+        line = ('%06d ' % (num)) + 'x' * max(self.line_size - 7, 0)
+        if self.random.random() < self.non_utf8:
+            line = line[:-4] + '\xe9\xe8\xe0\xe7'
+        return line
+
+    # Create a log dir under parent and return its name
+    def gen_testsuite(self, parent):
+        self.suite_count += 1
+        name = 'qa_bench%04d' % (self.suite_count)
+        dirname = '%s-2016-01-01-00-%02d-%02d' % (name, self.suite_count / 60 % 60,
+                                                    self.suite_count % 60)
+        path = os.path.join(parent, dirname)
+        os.makedirs(path)
+        with file(os.path.join(path, J.TestsuiteParser.TEST_RESULTS), 'w') as results:
+            for i in range(self.testcases):
+                testcase = 'testcase_%05d' % (i)
+                result = self.random.choice(self.RESULTS)
+                results.write("%s\n%s\n" % (testcase, ' '.join(map(str, result))))
+                with file(os.path.join(path, testcase), 'w') as f:
+                    for j in range(self.random.randint(0, self.lines)):
+                        f.write(self.gen_line(j))
+                        f.write('\n')
+        self.gen_submission(name)
+        return dirname
+
+    def gen_submission(self, name):
+        name = name.replace('qa_', '', 1)
+        path = os.path.join(self.submission_dir, 'submission-%s.log' % (name))
+        with file(path, 'w') as f:
+            for i in range(20):
+                f.write("Submitting results of %s, step %d\n" % (name, i))
+            f.write("Submission ID %d: http://qadb.example.com/submission/%d\n" % (self.suite_count,
+                                                                                self.suite_count))
+
+    def gen_tarball(self, index):
+        compression = self.compressions[index % len(self.compressions)]
+        tarball = os.path.join(self.log_dir, 'bench%04d-bench.tar.%s' % (index, compression))
+        tmp_dir = tempfile.mkdtemp(dir=self.root)
+        try:
+            for i in range(self.suites_per_tarball):
+                self.gen_testsuite(tmp_dir)
+            # tarfile of python2 can't write xz
+            cmd = "tar caf '%s' -C '%s' ." % (tarball, tmp_dir)
+            ret = subprocess.call(cmd, shell=True)
+            assert ret == 0, "Failed to create tarball: %s" % (cmd)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def generate(self):
+        for path in [self.log_dir, self.submission_dir]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        for i in range(self.dirs):
+            self.gen_testsuite(self.log_dir)
+        for i in range(self.tarballs):
+            self.gen_tarball(i)
+
+
+# Return the total size of the files under path
+def get_tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+# Return the peak RSS of the current process in bytes
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.times = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0) + time.time() - start
+
+
+# Convert the corpus step by step, timing every stage
+def run_stages(corpus, logger):
+    timer = StageTimer()
+    log_parser = J.TestsuitesParser('Benchmark', corpus.log_dir, logger)
+    testsuites = []
+
+    def parse_testsuite(path):
+        p = J.TestsuiteParser(path, logger)
+        with timer('parse'):
+            p.parse()
+        testsuites.append(p.get_result())
+
+    with timer('discovery'):
+        entries = glob.glob(os.path.join(corpus.log_dir, '*'))
+        tarballs = [e for e in entries if fnmatch.fnmatch(os.path.basename(e), log_parser.TARBALL_PATTERN)]
+        dirs = [e for e in entries if os.path.isdir(e)]
+    for tarball in tarballs:
+        p = J.TestsuiteTarballParser(tarball, logger)
+        with timer('extraction'):
+            p.create_extraction_dir()
+            p.extract()
+        try:
+            for path in glob.glob(os.path.join(p.extraction_dir, '*')):
+                parse_testsuite(path)
+        finally:
+            with timer('extraction'):
+                p.remove_extraction_dir()
+    for path in dirs:
+        parse_testsuite(path)
+    for testsuite in testsuites:
+        log_parser.add_statistics(testsuite)
+    log_data = log_parser.get_result()
+    log_data.testsuites = testsuites
+
+    converter = J.JunitConverter('Benchmark', corpus.log_dir, corpus.submission_dir, logger=logger)
+    with timer('submission'):
+        submission_data = converter.parse_submissions()
+        for testsuite in testsuites:
+            converter.add_submission_data(testsuite, submission_data)
+    # ElementTree path
+    with timer('xml_build'):
+        root = J.TestsuitesElement(log_data)
+    with timer('serialization'):
+        output = root.to_pretty_xml()
+    del root
+    # JunitWriter path, writing the same output
+    with timer('writer'):
+        f = cStringIO.StringIO()
+        J.JunitWriter(f).write_testsuites(log_data)
+    assert f.getvalue() == output, "JunitWriter output differs from ElementTree output"
+    return timer.times, None, len(output)
+
+
+# Run a whole conversion with JunitConverter
+def run_converter(corpus, logger, stream=False, **kwargs):
+    converter = J.JunitConverter('Benchmark', corpus.log_dir, corpus.submission_dir,
+                                logger=logger, **kwargs)
+    with tempfile.TemporaryFile() as f:
+        start = time.time()
+        if stream:
+            converter.stream(f)
+        else:
+            converter.run()
+            converter.dump(f)
+        elapsed = time.time() - start
+        output_size = f.tell()
+    return {'total': elapsed}, None, output_size
+
+
+# Parse test_results lines only, the number of lines is returned as items
+def run_result_lines(corpus, logger, count=200000):
+    rand = random.Random(0)
+    lines = []
+    for i in range(count):
+        result = list(rand.choice(CorpusGenerator.RESULTS))
+        result[3] = rand.randint(0, 600)
+        lines.append(' '.join(map(str, result)))
+    p = J.TestsuiteParser(os.path.join(corpus.log_dir, 'qa_bench-2016-01-01-00-00-00'), logger)
+    start = time.time()
+    for line in lines:
+        p.extract_result_line(line)
+    return {'total': time.time() - start}, len(lines), 0
+
+
+SCENARIOS = [
+    ('result_lines',    run_result_lines, {}),
+    ('stages',          run_stages,     {}),
+    ('default',         run_converter,  {}),
+    ('stream',          run_converter,  {'stream': True}),
+    ('no_extract',      run_converter,  {'stream': True, 'extract': False}),
+    ('jobs',            run_converter,  {'stream': True, 'extract': False, 'jobs': None}),
+]
+
+
+# Scenario functions return (times, items, output size). items is the
+# amount of processed items if they aren't testcases, otherwise None.
+def _scenario_worker(queue, func, corpus, kwargs):
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.CRITICAL)
+    J.TestsuiteParser.ID = 0
+    times, items, output_size = func(corpus, logger, **kwargs)
+    queue.put((times, items, output_size, get_peak_rss()))
+
+# Run a scenario in a child process and return its result
+def run_scenario(func, corpus, kwargs):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_scenario_worker, args=(queue, func, corpus, kwargs))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    assert proc.exitcode == 0, "Benchmark process failed: %s" % (func.__name__)
+    return result
+
+
+def benchmark(corpus, repeat=1, jobs=None):
+    jobs = jobs or multiprocessing.cpu_count()
+    input_size = get_tree_size(corpus.log_dir)
+    results = {}
+    for name, func, kwargs in SCENARIOS:
+        kwargs = dict(kwargs)
+        if 'jobs' in kwargs:
+            kwargs['jobs'] = jobs
+        best = None
+        for i in range(repeat):
+            times, items, output_size, peak_rss = run_scenario(func, corpus, kwargs)
+            if best is None:
+                best = {'times': times, 'items': items, 'peak_rss': peak_rss,
+                        'output_size': output_size}
+                continue
+            for stage, t in times.items():
+                best['times'][stage] = min(best['times'][stage], t)
+            best['peak_rss'] = max(best['peak_rss'], peak_rss)
+        best['input_size'] = input_size
+        results[name] = best
+    return results
+
+
+def print_results(results, testcases):
+    print "%-28s %10s %14s %10s %12s" % ('Scenario/stage', 'Seconds', 'Items/s', 'MB/s', 'Peak RSS MB')
+    for name, func, kwargs in SCENARIOS:
+        if name not in results:
+            continue
+        result = results[name]
+        items = result.get('items') or testcases
+        mb = result['input_size'] / 1024.0 / 1024.0
+        for stage, t in sorted(result['times'].items(), key=lambda x: -x[1]):
+            label = name if stage == 'total' else "%s.%s" % (name, stage)
+            t = max(t, 1e-9)
+            throughput = '-' if result.get('items') else '%.2f' % (mb / t)
+            print "%-28s %10.4f %14.1f %10s %12.1f" % (label, t, items / t, throughput,
+                                                        result['peak_rss'] / 1024.0 / 1024.0)
+
+
+# Compare results with a baseline and return the list of regressions
+def compare_results(results, baseline, threshold=0.1):
+    regressions = []
+    print "%-28s %10s %10s %8s" % ('Scenario/stage', 'Baseline', 'Current', 'Change')
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        items = [(stage, t, baseline[name]['times'].get(stage)) for stage, t in result['times'].items()]
+        items.append(('peak_rss', result['peak_rss'], baseline[name].get('peak_rss')))
+        for stage, current, base in sorted(items):
+            if not base:
+                continue
+            change = (current - base) / float(base)
+            flag = ''
+            if change > threshold:
+                flag = ' <- regression'
+                regressions.append("%s.%s" % (name, stage))
+            print "%-28s %10.4g %10.4g %+7.1f%%%s" % ("%s.%s" % (name, stage), base, current,
+                                                    change * 100, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    usage = '''Usage: %prog [options]
+
+  Options:
+    --corpus            Generate the corpus in DIR and keep it. Reused if it exists
+    --dirs              Amount of plain log dirs. Default: 4
+    --tarballs          Amount of log tarballs. Default: 8
+    --suites-per-tarball    Log dirs in each tarball. Default: 1
+    --testcases         Testcases per testsuite. Default: 50
+    --lines             Max lines per testcase log. Default: 200
+    --line-size         Characters per log line. Default: 80
+    --non-utf8          Ratio of non UTF-8 log lines. Default: 0.01
+    --compressions      Tarball compressions. Default: bz2,gz,xz
+    -j|--jobs           Processes for the parallel scenario. Default: CPU count
+    -r|--repeat         Run each scenario N times and keep the best. Default: 1
+    --save              Save results to FILE as a baseline
+    --compare           Compare results with the baseline in FILE
+    --threshold         Slowdown ratio reported as regression. Default: 0.1
+'''
+    op = OptionParser(usage=usage)
+    op.add_option('--corpus', dest='corpus', type='string')
+    op.add_option('--dirs', dest='dirs', type='int', default=4)
+    op.add_option('--tarballs', dest='tarballs', type='int', default=8)
+    op.add_option('--suites-per-tarball', dest='suites_per_tarball', type='int', default=1)
+    op.add_option('--testcases', dest='testcases', type='int', default=50)
+    op.add_option('--lines', dest='lines', type='int', default=200)
+    op.add_option('--line-size', dest='line_size', type='int', default=80)
+    op.add_option('--non-utf8', dest='non_utf8', type='float', default=0.01)
+    op.add_option('--compressions', dest='compressions', type='string', default='bz2,gz,xz')
+    op.add_option('-j', '--jobs', dest='jobs', type='int')
+    op.add_option('-r', '--repeat', dest='repeat', type='int', default=1)
+    op.add_option('--save', dest='save', type='string')
+    op.add_option('--compare', dest='compare', type='string')
+    op.add_option('--threshold', dest='threshold', type='float', default=0.1)
+    (options, args) = op.parse_args()
+
+    logging.basicConfig(format='[%(name)s]%(levelname)s: %(message)s')
+    if options.corpus:
+        root = J.expand_path(options.corpus)
+    else:
+        root = tempfile.mkdtemp(prefix='junit_bench_')
+    corpus = CorpusGenerator(root,
+                            dirs=options.dirs,
+                            tarballs=options.tarballs,
+                            suites_per_tarball=options.suites_per_tarball,
+                            testcases=options.testcases,
+                            lines=options.lines,
+                            line_size=options.line_size,
+                            non_utf8=options.non_utf8,
+                            compressions=options.compressions.split(','))
+    try:
+        if not os.path.isdir(corpus.log_dir):
+            start = time.time()
+            corpus.generate()
+            print "Generated corpus in %s(%.1fs)" % (root, time.time() - start)
+        testcases = (options.dirs + options.tarballs * options.suites_per_tarball) * options.testcases
+        results = benchmark(corpus, repeat=options.repeat, jobs=options.jobs)
+        print_results(results, testcases)
+        ret = 0
+        if options.compare:
+            with file(options.compare, 'r') as f:
+                baseline = json.load(f)
+            if baseline['corpus'] != corpus.get_params():
+                print "Warning: the baseline was made with another corpus: %s" % (baseline['corpus'])
+            print
+            regressions = compare_results(results, baseline['results'], options.threshold)
+            if regressions:
+                print "Regressions: %s" % (', '.join(regressions))
+                ret = 1
+        if options.save:
+            with file(options.save, 'w') as f:
+                json.dump({'corpus': corpus.get_params(), 'results': results}, f, indent=2, sort_keys=True)
+    finally:
+        if not options.corpus:
+            shutil.rmtree(root)
+    sys.exit(ret)
@@ -1,22 +1,51 @@
 #!/usr/bin/env python2
 # -*- coding: UTF-8 -*-
+# Convert qaset logs to junit xml.
+#
+# Can be imported, importing it has no side effects on other modules:
+#   import junit_xml_gen
+#   junit_xml_gen.generate('Kernel Regression', '/var/log/qaset/log',
+#                           [('xml', 'junit.xml')],
+#                           submission_dir='/var/log/qaset/submission')
+import collections
+import contextlib
+import cPickle as pickle
+import cProfile
 from datetime import timedelta, datetime
 import fnmatch
 import glob
+import hashlib
 import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 from optparse import OptionParser
 import random
 import re
+import resource
 import shutil
+import signal
 import sys
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
 import socket
+import StringIO
 import traceback
 import xml.dom.minidom as MINIDOM
 import xml.etree.ElementTree as ET
+try:
+    import chardet
+except ImportError:
+    chardet = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 ### Utils functions ###
 # Expand ~ and env vars of a path and return its absolute path
@@ -26,51 +55,453 @@ def expand_path(path):
     path = os.path.abspath(path)
     return path
 
+# Normalize a testsuite name: qa_foo-bar => foo_bar
+def normalize_testsuite_name(name):
+    name = name.strip()
+    name = re.sub(r'^qa[_\-]', '', name)   # Remove prefix: qa_
+    name = name.replace('-', '_')           # Replace - with _
+    return name
+
 # Replace ]]> with ]]&gt;
 def escape_cdata_text(text):
     return text.replace(']]>', ']]&gt;')
 
+class TextDecoder(object):
+    '''
+    Detect raw string encoding and convert it to unicode object.
+
+    UTF-8(and so ASCII) text is decoded right away. Otherwise the encoding
+    detected by chardet(if installed) and a list of common encodings are
+    tried. The encoding that worked is cached per source(e.g. a testsuite),
+    so the other texts of the same source don't need detection.
+    '''
+    ENCODINGS = ['UTF-8', 'ASCII',                                      # ASCII and unicode
+                'windows-1252', 'latin-1',                              # English
+                'ISO-8859-5', 'windows-1251',                           # Bulgarian
+                'ISO-8859-16',                                          # German
+                'ISO-8859-2', 'windows-1250',                           # Hungarian
+                'ISO-8859-5', 'windows-1251',                           # Cyrillic
+                'Big5', 'GBK',                                          # Chinese
+                'ISO-8859-7', 'windows-1253']                           # Greek
+    SAMPLE_SIZE = 64 * 1024
+
+    # sample_size: Bytes passed to chardet. None to use the whole text
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.encodings = {}     # {<source>: <encoding>}
+
+    # Return the encoding detected by chardet or None
+    def detect(self, raw_str):
+        if chardet is None:
+            return None
+        if self.sample_size is not None:
+            raw_str = raw_str[:self.sample_size]
+        try:
+            return chardet.detect(raw_str)['encoding']
+        except Exception, e:
+            return None
+
+    # Yield the encodings to try, chardet is only run if the encoding
+    # cached for source is missing or doesn't work
+    def iter_encodings(self, raw_str, source):
+        yield self.encodings.get(source)
+        yield self.detect(raw_str)
+        for encoding in self.ENCODINGS:
+            yield encoding
+
+    def decode(self, raw_str, source=None):
+        if isinstance(raw_str, unicode):
+            return raw_str
+        try:
+            return raw_str.decode('UTF-8')
+        except UnicodeDecodeError, e:
+            pass
+        with STATS.stage('detection'):
+            for encoding in self.iter_encodings(raw_str, source):
+                if encoding is None:
+                    continue
+                try:
+                    text = raw_str.decode(encoding)
+                except (UnicodeDecodeError, LookupError), e:
+                    continue
+                if source is not None:
+                    self.encodings[source] = encoding
+                return text
+        raise ValueError("Unknown encoding: %s" % (raw_str))
+
+DECODER = TextDecoder()
+
 # Detect raw string encoding and convert it to unicode object
 # Note: This function uses chardet lib to detect encoding,
 #       but should work as well without it
-def str_to_unicode(raw_str):
-    try:
-        # Use chardet to detect encoding
-        import chardet
-        res = chardet.detect(raw_str)
-        return unicode(raw_str, res['encoding'])
-    except:
-        # Try all possible encodings
-        for encoding in ['UTF-8', 'ASCII',                                      # ASCII and unicode
-                        'windows-1252', 'latin-1',                              # English
-                        'ISO-8859-5', 'windows-1251',                           # Bulgarian
-                        'ISO-8859-16',                                          # German
-                        'ISO-8859-2', 'windows-1250',                           # Hungarian
-                        'ISO-8859-5', 'windows-1251',                           # Cyrillic
-                        'Big5', 'GBK',                                          # Chinese
-                        'ISO-8859-7', 'windows-1253']:                          # Greek
-            try:
-                return unicode(raw_str, encoding)
-            except:
-                continue
-    raise ValueError("Unknown encoding: %s" % (raw_str))
+def str_to_unicode(raw_str, source=None):
+    return DECODER.decode(raw_str, source)
+
+class StatsTimer(object):
+    '''
+    Measure the time, bytes and files read between __enter__ and __exit__.
+    Timers nest, bytes and files are added to all the running ones.
+    '''
+    def __init__(self, stats, name, testsuite_parser=None):
+        self.stats = stats
+        self.name = name
+        self.testsuite_parser = testsuite_parser
+        self.bytes = 0
+        self.files = 0
+
+    def __enter__(self):
+        self.stats.get_running().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.start
+        self.stats.get_running().remove(self)
+        self.stats.add(self, seconds)
+
+
+class NullTimer(object):
+    '''
+    Used when stats are disabled
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+NULL_TIMER = NullTimer()
+
 
-def read_last_lines(path, count=50):
+class Stats(object):
+    '''
+    Wall time, bytes read, files read and peak memory(max RSS of the
+    process when the stage ended) of the conversion stages and of each
+    testsuite. Disabled by default, the probes do nothing then.
+
+    Stage times include the nested stages, e.g. parse includes tail.
+    '''
+    # Stages in report order
+    STAGES = ['discovery',      # Listing log dir
+            'dedup',            # Fingerprinting tarballs to find duplicates
+            'cache',            # Loading parsed tarballs/dirs from the ParseCache
+            'extraction',       # Extracting/reading tarballs
+            'parse',            # Parsing testsuite dirs
+            'tail',             # Reading the end of log files
+            'detection',        # Detecting encodings of non UTF-8 text
+            'submission',       # Parsing submission files
+            'write']            # Writing outputs
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        # {<stage>: [<calls>, <seconds>, <bytes>, <files>, <max rss KB>]}
+        self.stages = {}
+        # [(<seconds>, <bytes>, <files>, <testcases>, <max rss KB>, <name>, <path>)]
+        self.testsuites = []
+
+    # Running timers of the current thread
+    def get_running(self):
+        running = getattr(self.local, 'running', None)
+        if running is None:
+            running = self.local.running = []
+        return running
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return StatsTimer(self, name)
+
+    # Measure the parsing of a testsuite by a TestsuiteParser
+    def testsuite(self, testsuite_parser):
+        if not self.enabled:
+            return NULL_TIMER
+        return StatsTimer(self, None, testsuite_parser)
+
+    # Count bytes/files read for the running timers
+    def add_read(self, size, files=1):
+        if not self.enabled:
+            return
+        for timer in self.get_running():
+            timer.bytes += size
+            timer.files += files
+
+    def add(self, timer, seconds):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with self.lock:
+            if timer.testsuite_parser is None:
+                self.add_stage(timer.name, [1, seconds, timer.bytes, timer.files, max_rss])
+            else:
+                data = timer.testsuite_parser.data
+                self.testsuites.append((seconds, timer.bytes, timer.files,
+                                        len(data.testcases or []), max_rss,
+                                        data.name, timer.testsuite_parser.source))
+
+    def add_stage(self, name, values):
+        stage = self.stages.setdefault(name, [0, 0, 0, 0, 0])
+        for i in range(4):
+            stage[i] += values[i]
+        stage[4] = max(stage[4], values[4])
+
+    # Return and forget the data collected, e.g. by a worker process
+    def take(self):
+        data = (self.stages, self.testsuites)
+        self.reset()
+        return data
+
+    # Add data returned by take()
+    def merge(self, data):
+        stages, testsuites = data
+        with self.lock:
+            for name, values in stages.items():
+                self.add_stage(name, values)
+            self.testsuites.extend(testsuites)
+
+    # Print the stages and the top slowest testsuites
+    def report(self, f, top=10):
+        mb = lambda kb: kb / 1024.0
+        f.write("%-12s %8s %10s %14s %8s %13s\n" % ('Stage', 'Calls', 'Time(s)', 'Bytes',
+                                                    'Files', 'Peak RSS(MB)'))
+        names = [name for name in self.STAGES if name in self.stages]
+        names += sorted(name for name in self.stages if name not in self.STAGES)
+        for name in names:
+            calls, seconds, size, files, max_rss = self.stages[name]
+            f.write("%-12s %8d %10.3f %14d %8d %13.1f\n" % (name, calls, seconds, size,
+                                                            files, mb(max_rss)))
+        f.write("%-12s %8s %10.3f %14s %8s %13.1f\n" % ('total', '', time.time() - self.start,
+                                '', '', mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+        if top <= 0 or not self.testsuites:
+            return
+        f.write("\nSlowest testsuites(%d of %d):\n" % (min(top, len(self.testsuites)),
+                                                        len(self.testsuites)))
+        f.write("%10s %14s %8s %8s %13s  %s\n" % ('Time(s)', 'Bytes', 'Files', 'Tests',
+                                                    'Peak RSS(MB)', 'Testsuite'))
+        for seconds, size, files, tests, max_rss, name, path in sorted(self.testsuites,
+                                                                    reverse=True)[:top]:
+            f.write("%10.3f %14d %8d %8d %13.1f  %s(%s)\n" % (seconds, size, files, tests,
+                                                            mb(max_rss), name, path))
+
+STATS = Stats()
+
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Split data into lines the way iterating over a file does
+def split_lines(data):
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+# Read a file object to the end in blocks and return its last lines.
+# Works on streams that can't seek, e.g. members of a compressed tarball.
+# max_line_bytes: Longer lines are cut while reading, so they never take
+#                 more memory than that. Cut lines are 1 byte longer for
+#                 limit_log() to mark them.
+def tail_lines(f, count=50, block_size=TAIL_BLOCK_SIZE, max_line_bytes=None):
+    if not isinstance(count, int):
+        count = None
+    lines = collections.deque(maxlen=count)
+    rest = ''
+    cut = False     # Skipping the end of a cut line
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        if cut:
+            i = block.find('\n')
+            if i < 0:
+                continue
+            lines.append(rest)
+            rest = ''
+            cut = False
+            block = block[i + 1:]
+        parts = (rest + block).split('\n')
+        rest = parts.pop()
+        lines.extend(parts)
+        if max_line_bytes and len(rest) > max_line_bytes:
+            rest = rest[:max_line_bytes + 1]
+            cut = True
+    if rest:
+        lines.append(rest)
+    return os.linesep.join(line.strip() for line in lines)
+
+# Return the last lines of a file. The file is read backwards from the end
+# in blocks until enough lines are found, so the cost doesn't depend on the
+# file size.
+# max_bytes: Stop reading after that many bytes even if lines are missing
+def read_last_lines(path, count=50, block_size=TAIL_BLOCK_SIZE, max_bytes=None):
     path = expand_path(path)
-    lines = []
-    with file(path, 'r') as f:
-        for line in f:
-            if isinstance(count, int) and len(lines) >= count:
-                lines.pop(0)
-            lines.append(line.strip())
-    return os.linesep.join(lines)
+    with STATS.stage('tail'), file(path, 'rb') as f:
+        if not isinstance(count, int):
+            text = tail_lines(f, count, block_size)
+            STATS.add_read(f.tell())
+            return text
+        f.seek(0, os.SEEK_END)
+        end = pos = f.tell()
+        blocks = []
+        newlines = 0
+        # One more newline than lines is needed: the last line may end with one
+        while pos > 0 and newlines <= count and not(max_bytes and end - pos >= max_bytes):
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size)
+            newlines += block.count('\n')
+            blocks.append(block)
+        STATS.add_read(end - pos)
+    blocks.reverse()
+    lines = split_lines(''.join(blocks))
+    if pos > 0 and len(lines) > 1:
+        # The first line may be cut. Kept if it's the only one(max_bytes)
+        lines = lines[1:]
+    if count <= 0:
+        return ''
+    return os.linesep.join(line.strip() for line in lines[-count:])
+
+TRUNCATED_MARK = '[...]'
+
+# Return the first size bytes of a string, without cutting a UTF-8
+# character in two so the text can still be decoded as UTF-8
+def cut_utf8(s, size):
+    s = s[:size]
+    for i in range(4):
+        try:
+            s[:len(s) - i].decode('UTF-8')
+        except UnicodeDecodeError, e:
+            continue
+        return s[:len(s) - i]
+    # Not UTF-8 anyway
+    return s
+
+# Limit the size of a log returned by read_last_lines()
+# max_line_bytes: Longer lines are cut and end with TRUNCATED_MARK
+# max_bytes: Only the last max_bytes of the log are kept, after a line
+#            with TRUNCATED_MARK
+def limit_log(text, max_line_bytes=None, max_bytes=None):
+    if max_line_bytes and len(text) > max_line_bytes:
+        lines = text.split(os.linesep)
+        for i in range(len(lines)):
+            if len(lines[i]) > max_line_bytes:
+                lines[i] = cut_utf8(lines[i], max_line_bytes) + TRUNCATED_MARK
+        text = os.linesep.join(lines)
+    if max_bytes and len(text) > max_bytes:
+        text = text[-max_bytes:]
+        i = text.find(os.linesep)
+        if i >= 0:
+            # Drop the cut line
+            text = text[i + len(os.linesep):]
+        else:
+            # Drop the end of a cut UTF-8 character
+            for j in range(3):
+                if text and '\x80' <= text[0] <= '\xbf':
+                    text = text[1:]
+        text = TRUNCATED_MARK + os.linesep + text
+    return text
+
+class SpilledLog(object):
+    '''
+    A testcase log moved to the spool file of a LogBudget
+    '''
+    __slots__ = ('spool', 'offset', 'size')
+
+    def __init__(self, spool, offset, size):
+        self.spool = spool
+        self.offset = offset
+        self.size = size
+
+    def read(self):
+        self.spool.seek(self.offset)
+        return self.spool.read(self.size)
+
+    # Pickled(cache, worker processes) as the text itself
+    def __reduce__(self):
+        return (str, (self.read(),))
+
+# Return the text of a testcase log, reading it back if it was spilled
+def get_log_text(log):
+    if isinstance(log, SpilledLog):
+        return log.read()
+    return log
+
+class LogBudget(object):
+    '''
+    Limit the memory used by the testcase logs(system-out) kept until the
+    output is written. Once max_size bytes are held, the next logs are
+    either spilled to a temporary file and read back when writing them, or
+    truncated to their last TRUNCATED_SIZE bytes.
+    '''
+    MAX_SIZE        = 256 * 1024 * 1024
+    TRUNCATED_SIZE  = 1024
+    OVERFLOW_MODES  = ['spill', 'truncate']
+
+    # max_size: Bytes of logs kept in memory. None for no limit
+    # overflow: What to do with logs over max_size: spill or truncate
+    def __init__(self, max_size=MAX_SIZE, overflow='spill', logger=None):
+        assert overflow in self.OVERFLOW_MODES, "Unknown overflow mode: %s" % (overflow)
+        self.max_size = max_size
+        self.overflow = overflow
+        if logger is None:
+            self.logger = logging.getLogger(self.__class__.__name__)
+        else:
+            self.logger = logger
+        self.reset()
+
+    # Start counting again, e.g. for another conversion. Logs already spilled
+    # stay in the previous spool file.
+    def reset(self):
+        self.used = 0
+        self.spool = None
+        self.overflowed = 0
+
+    # Return the log to keep instead of text
+    def store(self, text):
+        if not self.max_size or not text or self.used + len(text) <= self.max_size:
+            self.used += len(text or '')
+            return text
+        if self.overflowed == 0:
+            self.logger.warning("Testcase logs take more than %d MB, %s the next ones" %
+                                (self.max_size / 1024 / 1024,
+                                'spilling' if self.overflow == 'spill' else 'truncating'))
+        self.overflowed += 1
+        if self.overflow == 'truncate':
+            text = limit_log(text, max_bytes=self.TRUNCATED_SIZE)
+            self.used += len(text)
+            return text
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        self.spool.seek(0, os.SEEK_END)
+        offset = self.spool.tell()
+        self.spool.write(text)
+        return SpilledLog(self.spool, offset, len(text))
+
+    # Apply the budget to the logs of a testsuite
+    def hold(self, testsuite):
+        for testcase in testsuite.testcases:
+            testcase.system_out = self.store(testcase.system_out)
+
+    # Stop counting the logs of a testsuite held before and now dropped.
+    # Spilled logs stay in the spool file.
+    def release(self, testsuite):
+        for testcase in testsuite.testcases:
+            if not isinstance(testcase.system_out, SpilledLog):
+                self.used -= len(testcase.system_out or '')
+
+LOG_BUDGET = LogBudget()
 
 ###### xml.etree.ElementTree Hack ######
 # Hack xml.etree.ElementTree to support CDATA tag
 # Generate a CDATA element
-def CDATA(text=None):
+# source: Key of the encoding cache, e.g. the testsuite name
+def CDATA(text=None, source=None):
     element = ET.Element('![CDATA[')
     element.text = text
+    if source is not None:
+        element.set('source', source)
     return element
 
 # Hack xml.etree.ElementTree to generate pretty xml
@@ -81,7 +512,7 @@ def _serialize_xml(write, elem, encoding, qnames, namespaces, level=0):
     text = elem.text
     if tag == '![CDATA[':
         # CDATA. Do NOT escape special characters except ]]>
-        u = str_to_unicode(escape_cdata_text(text))
+        u = str_to_unicode(escape_cdata_text(text), elem.get('source'))
         write("<%s%s\n]]>\n" % (tag, u.encode(encoding)))
     elif tag is ET.Comment:
         write("%s<!--%s-->\n" % (_indent_gen(level),
@@ -141,7 +572,133 @@ def _serialize_xml(write, elem, encoding, qnames, namespaces, level=0):
         write("%s%s\n" % (_indent_gen(level),
                             ET._escape_cdata(elem.tail, encoding)))
 
-ET._serialize_xml = ET._serialize['xml'] = _serialize_xml
+# Install _serialize_xml in ElementTree only while serializing, so the
+# module stays untouched for other users
+@contextlib.contextmanager
+def patched_element_tree():
+    orig_serialize_xml = ET._serialize_xml
+    ET._serialize_xml = ET._serialize['xml'] = _serialize_xml
+    try:
+        yield
+    finally:
+        ET._serialize_xml = ET._serialize['xml'] = orig_serialize_xml
+
+# Serialize a single element(and its children) at the given indent level
+def serialize_element(write, elem, encoding, level=0):
+    qnames, namespaces = ET._namespaces(elem, encoding, None)
+    _serialize_xml(write, elem, encoding, qnames, namespaces, level)
+
+
+class Record(object):
+    '''
+    Base class of the records holding parsed data.
+
+    Values live in __slots__ instead of a dict per object. FIELDS lists the
+    keys of the dicts used before, a '-' in a key is a '_' in the attribute
+    name. Dict style access is kept for code expecting dicts:
+        record['system-out'], record.get('classname'), record.items()
+    '''
+    __slots__ = ()
+    FIELDS = ()
+
+    # kwargs: Attribute values, missing ones are None
+    def __init__(self, **kwargs):
+        for attr in self.__slots__:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError("Unknown fields of %s: %s" % (self.__class__.__name__,
+                                                        ', '.join(kwargs.keys())))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key.replace('-', '_'))
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key.replace('-', '_'), value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key.replace('-', '_'))
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def values(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def items(self):
+        return zip(self.FIELDS, self.values())
+
+    def copy(self):
+        return self.__class__(**dict(zip(self.__slots__, self.values())))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    # Objects with __slots__ need these to be pickled
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.to_dict())
+
+
+class TestcaseRecord(Record):
+    FIELDS = ('name',               # [str] testcase name
+            'classname',            # [str] <testsuite name>.<testcase name>
+            'time',                 # [int] time used(in seconds)
+            'status',               # [str] success/failure/error/skipped
+            'skipped',              # [str] Skip message
+            'failure',              # [dict] Example: {'type': 'failure',
+                                    #                   'message': '3/5 failure', 'text': '...'}
+            'error',                # [dict] Example: {'type': 'error',
+                                    #                   'message': '2/5 error', 'text': '...'}
+            'system-out',           # [str or SpilledLog] log(50 lines by default)
+            'submission_id',        # [str] Submission id, overrides the testsuite one
+            'submission_link')      # [str] Submission link, overrides the testsuite one
+    __slots__ = tuple(key.replace('-', '_') for key in FIELDS)
+
+
+class TestsuiteRecord(Record):
+    FIELDS = ('name',               # [str] Testsuite name
+            'tests',                # [int] The amount of tests
+            'failures',             # [int] The amount of failed tests
+            'errors',               # [int] The amount of tests with internal errors
+            'time',                 # [int] Time consumed by all its testcases(in seconds)
+            'skipped',              # [int] The amount of skipped tests
+            'timestamp',            # [str] Testsuite start time
+            'hostname',             # [str] Hostname
+            'id',                   # [int] Sequence number
+            'package',              # [str] Same as testsuite name
+            'testcases',            # [list] List of TestcaseRecords
+            'submission_id',        # [str] Submission id of all its testcases
+            'submission_link')      # [str] Submission link of all its testcases
+    __slots__ = FIELDS
+
+
+class TestsuitesRecord(Record):
+    FIELDS = ('name',               # [str] Test name(e.g.Kernel, Userspace regression)
+            'time',                 # [int] time used(in seconds)
+            'tests',                # [int] Amount of testsuites
+            'failures',             # [int] Amount of failed testsuites
+            'errors',               # [int] Amount of testsuites with internal errors
+            'skipped',              # [int] Amount of skipped testsuites
+            'testsuites')           # [list] List of TestsuiteRecords
+    __slots__ = FIELDS
 
 
 class BaseParser(object):
@@ -159,38 +716,49 @@ class BaseParser(object):
         return self.data
 
 
+# A parsed test result line of a test_results file
+ResultLine = collections.namedtuple('ResultLine', ['failure', 'success', 'count', 'time',
+                                                    'error', 'skipped', 'status'])
+
+
 class TestcaseParser(BaseParser):
+    LINE_COUNT      = 50
+    # Limits of the log, see limit_log(). None for no limit
+    MAX_LINE_BYTES  = 64 * 1024
+    MAX_BYTES       = 256 * 1024
+
     # Read and parse testcase log file
     # Status/time info are omitted because they're already in test_results file
-    def __init__(self, path, extracted, line_count=50, logger=None):
+    # extracted: ResultLine of the testcase
+    # line_count: Lines of the log to keep. Default: LINE_COUNT
+    # read_log: Function returning the last lines of the log:
+    #           read_log(path, count, max_bytes=None)
+    def __init__(self, path, extracted, line_count=None, logger=None, read_log=read_last_lines):
         super(self.__class__, self).__init__(path, logger)
         self.extracted = extracted
-        self.line_count = line_count
-        self.data = {'name'         : os.path.basename(path),   # [str] testcase name
-                    'time'          : extracted['time'],        # [int] time used(in seconds)
-                    'status'        : extracted['status'],      # [str] success/failure/error/skipped
-                    'skipped'       : None,                     # [str] Skip message
-                    'failure'       : None,                     # [dict] Example: {'type': 'failure',
-                                                                #                   'message': '3/5 failure', 'text': '...'}
-                    'error'         : None,                     # [dict] Example: {'type': 'error',
-                                                                #                   'message': '2/5 error', 'text': '...'}
-                    'system-out'    : None}                     # [str] log(50 lines by default)
+        self.line_count = line_count or TestcaseParser.LINE_COUNT
+        self.read_log = read_log
+        self.data = TestcaseRecord(name=os.path.basename(path),
+                                    time=extracted.time,
+                                    status=extracted.status)
 
     def parse_log(self):
-        self.data['system-out'] = read_last_lines(self.path, count=self.line_count)
+        text = self.read_log(self.path, count=self.line_count,
+                            max_bytes=TestcaseParser.MAX_BYTES)
+        self.data.system_out = limit_log(text, TestcaseParser.MAX_LINE_BYTES,
+                                        TestcaseParser.MAX_BYTES)
 
     def parse_skipped(self):
-        if self.extracted['status'] == 'skipped':
-            self.data['skipped'] = '%s/%s skipped' % (self.extracted['skipped'], self.extracted['count'])
+        if self.extracted.status == 'skipped':
+            self.data.skipped = '%s/%s skipped' % (self.extracted.skipped, self.extracted.count)
 
     def parse_failure_error(self):
         for status in ['failure', 'error']:
-            if self.extracted[status] > 0:
-                self.data[status] = {'type'     : status,
-                                    'message'   : '%s/%s %s' % (self.extracted[status],
-                                                                self.extracted['count'],
-                                                                status)}
-                self.data[status]['text'] = self.data[status]['message']
+            if getattr(self.extracted, status) > 0:
+                message = '%s/%s %s' % (getattr(self.extracted, status), self.extracted.count, status)
+                setattr(self.data, status, {'type'      : status,
+                                            'message'   : message,
+                                            'text'      : message})
 
     def parse(self):
         self.parse_log()
@@ -210,21 +778,28 @@ class TestsuiteParser(BaseParser):
     RESULT_ITEMS    = ['failure', 'success', 'count', 'time', 'error', 'skipped']
     TEST_RESULTS    = 'test_results'
     ID              = 0
+    # Testcase status => testsuite counter
+    STATUS_COUNTERS = {'failure'    : 'failures',
+                        'error'     : 'errors',
+                        'skipped'   : 'skipped'}
+    # Result lines repeat a lot, ResultLines are immutable so they're shared
+    RESULT_LINE_CACHE       = {}
+    RESULT_LINE_CACHE_SIZE  = 4096
 
     # path: Path to the log dir. Example: /usr/share/qa/ctcs2/qa_bzip2-2015-12-18-11-37-53
-    def __init__(self, path, logger=None):
-        super(self.__class__, self).__init__(path, logger)
-        self.data = {'name'     : None,                 # [str] Testsuite name
-                    'tests'     : 0,                    # [int] The amount of tests
-                    'failures'  : 0,                    # [int] The amount of failed tests
-                    'errors'    : 0,                    # [int] The amount of tests with internal errors
-                    'time'      : 0,                    # [int] Time consumed by all its testcases(in seconds)
-                    'skipped'   : 0,                    # [int] The amount of skipped tests
-                    'timestamp' : None,                 # [str] Testsuite start time
-                    'hostname'  : socket.gethostname(), # [str] Hostname
-                    'id'        : TestsuiteParser.ID,   # [int] Sequence number
-                    'package'   : None,                 # [str] Same as testsuite name
-                    'testcases' : []}                   # [list] List of testcases
+    # source: Where the log dir comes from, shown in the stats. Default: path
+    #         Example: <tarball>/<log dir> for a log dir extracted from a tarball
+    def __init__(self, path, logger=None, source=None):
+        super(TestsuiteParser, self).__init__(path, logger)
+        self.source = source or path
+        self.data = TestsuiteRecord(tests=0,
+                                    failures=0,
+                                    errors=0,
+                                    time=0,
+                                    skipped=0,
+                                    hostname=socket.gethostname(),
+                                    id=TestsuiteParser.ID,
+                                    testcases=[])
         TestsuiteParser.ID += 1
         self.test_results_file = os.path.join(self.path, TestsuiteParser.TEST_RESULTS)
 
@@ -234,35 +809,46 @@ class TestsuiteParser(BaseParser):
         m = re.search(r'(.*)-(\d+(?:-\d+){5})', basename)
         assert m is not None, "Invalid directory name: %s" % (basename)
         # Name & Package
-        self.data['name'] = m.group(1).strip()
-        self.data['name'] = re.sub(r'^qa[_\-]', '', self.data['name']) # Remove prefix: qa_
-        self.data['name'] = self.data['name'].replace('-', '_')         # Replace - with _
-        self.data['package'] = self.data['name']
+        name = normalize_testsuite_name(m.group(1))
+        self.data.name = name
+        self.data.package = name
         # Timestamp
         lst = m.group(2).split('-')
         date = '-'.join(lst[:3])
         time = ':'.join(lst[-3:])
-        self.data['timestamp'] = "%sT%s" % (date, time)
+        self.data.timestamp = "%sT%s" % (date, time)
 
-    # Parse test result line and return a dict.
+    # Parse test result line and return a ResultLine.
     # A test result line contains 6 numbers:
     #   <failure> <succeed> <count> <time> <error> <skipped>
     # 
-    # Return: {'status': <status>, }
+    # The status is the first non zero item of: skipped, success, error, failure
     def extract_result_line(self, line):
-        m = re.search(r'\d+(\s+\d+){5}', line) 
-        assert m is not None, "Invalid result line: %s" % (line)
+        cache = TestsuiteParser.RESULT_LINE_CACHE
+        result = cache.get(line)
+        if result is None:
+            result = self.parse_result_line(line)
+            if len(cache) >= TestsuiteParser.RESULT_LINE_CACHE_SIZE:
+                cache.clear()
+            cache[line] = result
+        return result
+
+    def parse_result_line(self, line):
         nums = line.split()
-        nums = map(int, nums)
-        assert nums[2] > 0, "No tests found: %s" % (line)
-        status = None
-        for i in [0, 4, 1, 5]:
-            if nums[i] > 0:
-                status = TestsuiteParser.RESULT_ITEMS[i]
-        extracted_data = {'status': status}
-        for i in range(len(TestsuiteParser.RESULT_ITEMS)):
-            extracted_data[TestsuiteParser.RESULT_ITEMS[i]] = nums[i]
-        return extracted_data
+        assert len(nums) == 6 and ''.join(nums).isdigit(), "Invalid result line: %s" % (line)
+        failure, success, count, time, error, skipped = map(int, nums)
+        assert count > 0, "No tests found: %s" % (line)
+        if skipped > 0:
+            status = 'skipped'
+        elif success > 0:
+            status = 'success'
+        elif error > 0:
+            status = 'error'
+        elif failure > 0:
+            status = 'failure'
+        else:
+            status = None
+        return ResultLine(failure, success, count, time, error, skipped, status)
 
     # Parse the test_results file
     # and save the result to self.data['testcases']
@@ -275,11 +861,12 @@ class TestsuiteParser(BaseParser):
     #               'skipped'   : 0},
     #               'log'       : <100 lines of the log>}]
     def parse_testcases(self):
-        self.data['testcases'] = []
+        self.data.testcases = []
         testcase_name = ''
         line_num = 0
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         self.logger.debug("Parsing file %s" % (self.test_results_file))
-        with file(self.test_results_file, 'r') as f:
+        with self.open_test_results() as f:
             # Parse test_results file line by line
             for line in f:
                 line_num += 1
@@ -287,11 +874,13 @@ class TestsuiteParser(BaseParser):
                 # Testcase name line
                 if line_num % 2 == 1:
                     testcase_name = line
-                    self.logger.debug("Parsing testcase %s" % (testcase_name))
+                    if debug:
+                        self.logger.debug("Parsing testcase %s" % (testcase_name))
                     assert len(testcase_name) != 0, "[%s:%s]Invalid format" % (self.test_results_file, line_num)
                     continue
                 # Test result line
-                self.logger.debug("Getting results of testcase %s" % (testcase_name))
+                if debug:
+                    self.logger.debug("Getting results of testcase %s" % (testcase_name))
                 try:
                     extracted = self.extract_result_line(line)
                 except Exception, e:
@@ -299,33 +888,72 @@ class TestsuiteParser(BaseParser):
                     self.logger.debug(traceback.format_exc())
                     raise e
                 try:
-                    tp = TestcaseParser(os.path.join(self.path, testcase_name), extracted, logger=self.logger)
+                    tp = self.create_testcase_parser(testcase_name, extracted)
                     tp.parse()
                 except Exception, e:
-                    self.logger.error("Failed to parse testcase %s.%s" % (self.data['name'],
+                    self.logger.error("Failed to parse testcase %s.%s" % (self.data.name,
                                                                         testcase_name))
                     self.logger.debug(traceback.format_exc())
                 testcase_data = tp.get_result()
-                testcase_data['classname'] = "%s.%s" % (self.data['name'], testcase_data['name'])
-                self.data['testcases'].append(testcase_data)
+                testcase_data.classname = "%s.%s" % (self.data.name, testcase_data.name)
+                self.data.testcases.append(testcase_data)
                 # Statistics for testsuite
-                self.data['time'] += testcase_data['time']
-                self.data['tests'] += 1
-                tmp = {'failure'    : 'failures',
-                        'error'     : 'errors',
-                        'skipped'   : 'skipped'}
-                for k, v in tmp.items():
-                    if testcase_data['status'] == k:
-                        self.data[v] += 1
+                self.data.time += testcase_data.time
+                self.data.tests += 1
+                counter = TestsuiteParser.STATUS_COUNTERS.get(testcase_data.status)
+                if counter is not None:
+                    setattr(self.data, counter, getattr(self.data, counter) + 1)
                 # Prepare for next loop
                 testcase_name = ''
         assert line_num % 2 == 0, ("No test result of testcase '%s'(%s:%s)" %
                                 (testcase_name, self.test_results_file, line_num))
 
+    # Open the test_results file
+    def open_test_results(self):
+        f = file(self.test_results_file, 'r')
+        STATS.add_read(os.fstat(f.fileno()).st_size)
+        return f
+
+    # Create the parser of a testcase log
+    def create_testcase_parser(self, testcase_name, extracted):
+        return TestcaseParser(os.path.join(self.path, testcase_name), extracted, logger=self.logger)
+
     # Parse all the data.
     def parse(self):
-        self.parse_testsuite_name_timestamp()
-        self.parse_testcases()
+        with STATS.stage('parse'), STATS.testsuite(self):
+            self.parse_testsuite_name_timestamp()
+            self.parse_testcases()
+
+
+class TestsuiteMemberParser(TestsuiteParser):
+    '''
+    Parse a testsuite log dir read from a tarball without extracting it.
+
+    files: {<file name>: <content>}. The test_results file is complete,
+           testcase logs only hold their last lines.
+    '''
+
+    # path: <tarball path>/<log dir name>
+    def __init__(self, path, files, logger=None):
+        super(TestsuiteMemberParser, self).__init__(path, logger)
+        self.files = files
+
+    def open_test_results(self):
+        if TestsuiteParser.TEST_RESULTS not in self.files:
+            raise IOError("No such file: %s" % (self.test_results_file))
+        STATS.add_read(len(self.files[TestsuiteParser.TEST_RESULTS]))
+        return contextlib.closing(StringIO.StringIO(self.files[TestsuiteParser.TEST_RESULTS]))
+
+    # Same signature as read_last_lines(). Lines are already cut.
+    def read_member_log(self, path, count=None, max_bytes=None):
+        name = os.path.basename(path)
+        if name not in self.files:
+            raise IOError("No such file: %s" % (path))
+        return self.files[name]
+
+    def create_testcase_parser(self, testcase_name, extracted):
+        return TestcaseParser(os.path.join(self.path, testcase_name), extracted,
+                            logger=self.logger, read_log=self.read_member_log)
 
 
 class TestsuiteTarballParser(BaseParser):
@@ -337,8 +965,11 @@ class TestsuiteTarballParser(BaseParser):
 
     # path: Path to the tarball containing logs. Example:
     #       /usr/share/qaset/log/gzip-ACAP2-20151216-20151216T110220.tar.bz2
-    def __init__(self, path, logger=None):
+    # extract: Extract the tarball to TMP_DIR with tar. Otherwise the tarball
+    #          is read as a stream without touching the disk.
+    def __init__(self, path, logger=None, extract=True):
         super(self.__class__, self).__init__(path, logger)
+        self.extract_tarball = extract
         self.extraction_dir = None
         self.data = []              # A list of testsuites
 
@@ -364,58 +995,206 @@ class TestsuiteTarballParser(BaseParser):
     # tarball: The path to the log tarball
     def extract(self):
         cmd = "tar xf '%s' -C '%s'" % (self.path, self.extraction_dir)
-        ret = subprocess.call(cmd, shell=True)
+        with STATS.stage('extraction'):
+            ret = subprocess.call(cmd, shell=True)
+            STATS.add_read(os.path.getsize(self.path))
         assert ret == 0, "Extraction failed: %s" % (cmd)
 
-    # Extract the tarball and parse the files inside it
-    def parse(self):
-        self.create_extraction_dir()
-        self.extract()
-        for entry in glob.glob(os.path.join(self.extraction_dir, '*')):
-            p = TestsuiteParser(entry, self.logger)
+    # Read the tarball as a stream and return the files of each log dir:
+    # [(<log dir name>, {<file name>: <content>}), ...]
+    # Only test_results files are kept entirely, other files are cut to their
+    # last TestcaseParser.LINE_COUNT lines(and MAX_LINE_BYTES) while reading.
+    def read_members(self):
+        dirs = collections.OrderedDict()
+        with STATS.stage('extraction'):
+            tar = tarfile.open(self.path, 'r|*')
+            try:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    parts = os.path.normpath(member.name).split('/')
+                    if len(parts) != 2:
+                        continue
+                    dirname, filename = parts
+                    f = tar.extractfile(member)
+                    if filename == TestsuiteParser.TEST_RESULTS:
+                        content = f.read()
+                    else:
+                        content = tail_lines(f, TestcaseParser.LINE_COUNT,
+                                            max_line_bytes=TestcaseParser.MAX_LINE_BYTES)
+                    STATS.add_read(member.size)
+                    dirs.setdefault(dirname, {})[filename] = content
+            finally:
+                tar.close()
+        return dirs.items()
+
+    # Yield the testsuites of the log dirs returned by read_members()
+    def iter_testsuites_from_members(self, members):
+        count = 0
+        for dirname, files in members:
+            p = TestsuiteMemberParser(os.path.join(self.path, dirname), files, self.logger)
             try:
                 p.parse()
-                self.data.append(p.get_result())
             except Exception, e:
-                self.logger.error("Failed to parse %s: %s" % (entry, e))
+                self.logger.error("Failed to parse %s: %s" % (p.path, e))
                 self.logger.debug(traceback.format_exc())
-        self.remove_extraction_dir()
+                continue
+            count += 1
+            yield p.get_result()
+        if count == 0:
+            self.logger.warning("No log data in %s" % (self.path))
+
+    # Extract the tarball and yield the testsuites inside it one by one.
+    # The extraction dir is removed once the generator is exhausted or closed.
+    def iter_testsuites(self):
+        if not self.extract_tarball:
+            try:
+                members = self.read_members()
+            except (tarfile.CompressionError, tarfile.ReadError), e:
+                # e.g. xz isn't supported by tarfile, let tar do it
+                self.logger.debug("Unable to read %s in process, extracting it: %s" % (self.path, e))
+            else:
+                for testsuite in self.iter_testsuites_from_members(members):
+                    yield testsuite
+                return
+        count = 0
+        self.create_extraction_dir()
+        try:
+            self.extract()
+            for entry in glob.glob(os.path.join(self.extraction_dir, '*')):
+                p = TestsuiteParser(entry, self.logger,
+                                    source=os.path.join(self.path, os.path.basename(entry)))
+                try:
+                    p.parse()
+                except Exception, e:
+                    self.logger.error("Failed to parse %s: %s" % (entry, e))
+                    self.logger.debug(traceback.format_exc())
+                    continue
+                count += 1
+                yield p.get_result()
+        finally:
+            self.remove_extraction_dir()
         # Check if there's any data
-        if len(self.data) == 0:
+        if count == 0:
             self.logger.warning("No log data in %s" % (self.path))
 
+    # Extract the tarball and parse the files inside it
+    def parse(self):
+        self.data = []
+        for testsuite in self.iter_testsuites():
+            self.data.append(testsuite)
+
 
 class SubmissionParser(BaseParser):
     '''
     Parse all submission logs to get submission ids and links.
-    '''
 
-    def __init__(self, path, logger=None):
+    Only the last lines of each file are read, files are read by a thread
+    pool, and results are cached by file mtime/size for the life of the
+    process. get() parses the files of one testsuite on first use.
+    '''
+    JOBS            = 8
+    # Starting and joining a pool takes ~0.1s, not worth it for a few files
+    MIN_POOL_FILES  = 64
+    LINE_COUNT      = 10
+    CACHE           = {}    # {<file path>: (<mtime>, <size>, <result>, <error>)}
+
+    # jobs: Number of threads reading submission files
+    def __init__(self, path, logger=None, jobs=JOBS):
         super(self.__class__, self).__init__(path, logger)
-        self.data = {}  # A list containing all the submission links and ids
+        self.jobs = jobs
+        # {<normalized testsuite name>: {'id': <id>, 'link': <link>}}
+        self.data = {}
+        self.mtimes = {}    # {<normalized testsuite name>: <submission file mtime>}
+        self.files = None   # {<normalized testsuite name>: [<submission file path>]}
 
+    # Return the normalized testsuite name, the same as TestsuiteRecord.name
     def get_testsuite_name(self, submission_file_name):
         m = re.search(r'^submission-(.*)\.log$', submission_file_name)
         assert m is not None, "Can't detect testsuite name: %s" % (submission_file_name)
-        name = m.group(1).strip().replace('-', '_')
-        return m.group(1)
+        return normalize_testsuite_name(m.group(1))
 
-    def parse_submission(self, submission_file_path):
+    # Read the last lines of a submission file and return {'id': <id>, 'link': <link>}
+    def read_submission(self, submission_file_path):
         file_name = os.path.basename(submission_file_path)
-        testsuite_name = self.get_testsuite_name(file_name)
-        s = read_last_lines(submission_file_path, 10)
+        s = read_last_lines(submission_file_path, self.LINE_COUNT)
         m = re.search(r'ID (\d+): (.*)$', s, re.MULTILINE | re.IGNORECASE)
         assert m is not None, "No submission id/link found: %s" % (file_name)
-        self.data[testsuite_name] = {'id': m.group(1), 'link': m.group(2)}
+        return {'id': m.group(1), 'link': m.group(2)}
 
-    def parse(self):
-        self.data = {}
+    # Parse a submission file, or take it from the cache if it's unchanged.
+    # Return (<mtime>, <result>), result is None if there's no submission
+    def parse_submission(self, submission_file_path):
+        try:
+            st = os.stat(submission_file_path)
+        except OSError, e:
+            self.logger.warning("%s" % e)
+            return None, None
+        cached = SubmissionParser.CACHE.get(submission_file_path)
+        if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+            result, error = cached[2:]
+        else:
+            result, error = None, None
+            try:
+                result = self.read_submission(submission_file_path)
+            except (AssertionError, IOError), e:
+                error = "%s" % e
+            SubmissionParser.CACHE[submission_file_path] = (st.st_mtime, st.st_size, result, error)
+        if error is not None:
+            self.logger.warning(error)
+        return st.st_mtime, result
+
+    # Find submission files: {<normalized testsuite name>: [<path>, ...]}
+    def list_files(self):
+        files = {}
         for entry in glob.glob(os.path.join(self.path, 'submission-*.log')):
             if os.path.isfile(entry):
+                name = self.get_testsuite_name(os.path.basename(entry))
+                files.setdefault(name, []).append(entry)
+        return files
+
+    # Parse submission files with the thread pool and save the results
+    def parse_files(self, names):
+        paths = []
+        for name in names:
+            paths.extend(self.files.get(name, []))
+        with STATS.stage('submission'):
+            if self.jobs > 1 and len(paths) >= self.MIN_POOL_FILES:
+                pool = ThreadPool(min(self.jobs, len(paths)))
                 try:
-                    self.parse_submission(entry)
-                except AssertionError, e:
-                    self.logger.warning("%s" % e)
+                    results = pool.map(self.parse_submission, paths)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = map(self.parse_submission, paths)
+        for path, (mtime, result) in zip(paths, results):
+            if result is None:
+                continue
+            testsuite_name = self.get_testsuite_name(os.path.basename(path))
+            # Different file names may have the same normalized name, keep the newest
+            if self.mtimes.get(testsuite_name, mtime) > mtime:
+                continue
+            self.mtimes[testsuite_name] = mtime
+            self.data[testsuite_name] = result
+
+    # names: Only parse the submissions of these testsuites. None for all
+    def parse(self, names=None):
+        self.data = {}
+        self.mtimes = {}
+        self.files = self.list_files()
+        if names is None:
+            names = self.files.keys()
+        self.parse_files(names)
+
+    # Return the submission of a testsuite, its files are parsed on first use
+    def get(self, name, default=None):
+        if self.files is None:
+            self.files = self.list_files()
+        if name not in self.data and name in self.files:
+            self.parse_files([name])
+            del self.files[name]
+        return self.data.get(name, default)
 
 
 class TestsuitesParser(BaseParser):
@@ -429,52 +1208,472 @@ class TestsuitesParser(BaseParser):
     RESULT_FILE_NAME    = 'test_results'
     TARBALL_PATTERN     = '*.tar.*'
     TMP_DIR             = '/tmp'
+    DEDUP_MODES         = ['keep', 'drop', 'off']
 
     # path: The directory containing log tarballs or log dirs.
     #   Example: /var/log/qaset/log/
-    def __init__(self, name, path, logger=None):
+    # jobs: Number of processes parsing tarballs/dirs in parallel
+    # extract: Extract tarballs to TMP_DIR instead of reading them in process
+    # cache: ParseCache to load unchanged tarballs/dirs from
+    # entries: The tarballs/dirs to parse if already known. Default: all in path
+    # dedup: What to do with tarballs having the same content as another one.
+    #   keep: Parse the content once, keep the testsuites of all the copies
+    #   drop: Parse the content once, drop the testsuites of the copies
+    #   off:  Parse every copy
+    # budget: LogBudget applied to the testcase logs kept. None for no limit
+    def __init__(self, name, path, logger=None, jobs=1, extract=True, cache=None, entries=None,
+                dedup='keep', budget=None):
         super(self.__class__, self).__init__(path, logger)
-        self.data = {'name'     : name,     # [str] Test name(e.g.Kernel, Userspace regression)
-                    'time'      : 0,        # [int] time used(in seconds)
-                    'tests'     : 0,        # [int] Amount of testsuites
-                    'failures'  : 0,        # [int] Amount of failed testsuites
-                    'errors'    : 0,        # [int] Amount of testsuites with internal errors
-                    'skipped'   : 0,        # [int] Amount of skipped testsuites
-                    'testsuites': []}       # [list] List of testsuites
-
-    # Parse all the tarballs or dirs in self.path
-    def parse(self):
-        for entry in glob.glob(os.path.join(self.path, '*')):
-            if fnmatch.fnmatch(os.path.basename(entry), '*.tar.*'):
-                p = TestsuiteTarballParser(entry, self.logger)
-            elif os.path.isdir(entry):
-                p = TestsuiteParser(entry, self.logger)
-            else:
-                self.logger.warning("Unknown entry '%s'" % (entry))
+        assert dedup in self.DEDUP_MODES, "Unknown dedup mode: %s" % (dedup)
+        self.jobs = jobs
+        self.extract = extract
+        self.cache = cache
+        self.entries = entries
+        self.dedup = dedup
+        self.budget = budget
+        self.data = TestsuitesRecord(name=name,
+                                    time=0,
+                                    tests=0,
+                                    failures=0,
+                                    errors=0,
+                                    skipped=0,
+                                    testsuites=[])
+
+    # Yield the testsuites of one tarball or dir in self.path
+    def iter_entry(self, entry):
+        if fnmatch.fnmatch(os.path.basename(entry), self.TARBALL_PATTERN):
+            p = TestsuiteTarballParser(entry, self.logger, extract=self.extract)
+            try:
+                for testsuite in p.iter_testsuites():
+                    yield testsuite
+            except Exception, e:
+                self.logger.error("Failed to parse %s: %s" % (entry, e))
+                self.logger.debug(traceback.format_exc())
+        elif os.path.isdir(entry):
+            p = TestsuiteParser(entry, self.logger)
             try:
                 p.parse()
             except Exception, e:
                 self.logger.error("Failed to parse %s: %s" % (entry, e))
                 self.logger.debug(traceback.format_exc())
-            testsuites_data = p.get_result()
-            if not isinstance(testsuites_data, list):
-                testsuites_data = [testsuites_data]
-            # Statistics for testsuites
-            for testsuite in testsuites_data:
-                self.data['time'] += testsuite['time']
-                self.data['tests'] += testsuite['tests']
-                self.data['failures'] += testsuite['failures']
-                self.data['errors'] += testsuite['errors']
-                self.data['skipped'] += testsuite['skipped']
-            self.data['testsuites'].extend(testsuites_data)
+            yield p.get_result()
+        else:
+            self.logger.warning("Unknown entry '%s'" % (entry))
+
+    # Find the tarballs with the same content. Sizes are compared first, then
+    # sample fingerprints, the whole content is only hashed when they match.
+    # Dirs are skipped: their names are part of their fingerprint, so the
+    # dirs of a path never match.
+    # Return {<duplicate entry>: <first entry with the same content>}
+    def find_duplicates(self, entries):
+        sizes = collections.OrderedDict()   # {<size>: [<entry>]}
+        groups = collections.OrderedDict()  # {<sample fingerprint>: [<entry>]}
+        with STATS.stage('dedup'):
+            for entry in entries:
+                if not fnmatch.fnmatch(os.path.basename(entry), self.TARBALL_PATTERN):
+                    continue
+                try:
+                    sizes.setdefault(os.path.getsize(entry), []).append(entry)
+                except OSError, e:
+                    self.logger.debug("Unable to stat %s: %s" % (entry, e))
+            for entry in [entry for group in sizes.values() if len(group) > 1 for entry in group]:
+                try:
+                    groups.setdefault(sample_fingerprint(entry), []).append(entry)
+                except (IOError, OSError), e:
+                    self.logger.debug("Unable to fingerprint %s: %s" % (entry, e))
+            duplicates = {}
+            for group in groups.values():
+                if len(group) < 2:
+                    continue
+                originals = {}      # {<full fingerprint>: <entry>}
+                for entry in group:
+                    try:
+                        key = full_fingerprint(entry)
+                    except (IOError, OSError), e:
+                        self.logger.debug("Unable to fingerprint %s: %s" % (entry, e))
+                        continue
+                    if key in originals:
+                        duplicates[entry] = originals[key]
+                        self.logger.info("Duplicate of %s: %s" % (originals[key], entry))
+                    else:
+                        originals[key] = entry
+        return duplicates
+
+    # Copy the testsuites of a duplicate tarball/dir from its original
+    def copy_testsuites(self, testsuites):
+        copies = []
+        for testsuite in testsuites:
+            testsuite = testsuite.copy()
+            testsuite.id = TestsuiteParser.ID
+            TestsuiteParser.ID += 1
+            copies.append(testsuite)
+        return copies
+
+    # Statistics for testsuites
+    def add_statistics(self, testsuite):
+        self.data.time += testsuite.time
+        self.data.tests += testsuite.tests
+        self.data.failures += testsuite.failures
+        self.data.errors += testsuite.errors
+        self.data.skipped += testsuite.skipped
+
+    # Parse one tarball or dir and return (testsuites, number of testsuite
+    # ids used). Ids of the returned testsuites start from 0, the caller
+    # shifts them so that they match the ones of a serial run.
+    def parse_entry(self, entry):
+        start_id = TestsuiteParser.ID
+        TestsuiteParser.ID = 0
+        try:
+            testsuites = list(self.iter_entry(entry))
+            return testsuites, TestsuiteParser.ID
+        finally:
+            TestsuiteParser.ID = start_id
+
+    # Parse the entries in a process pool and yield the results of
+    # parse_entry() in the same order as the entries
+    def iter_entries_parallel(self, entries):
+        options = {'extract': self.extract}
+        args = [(self.data.name, self.path, entry, self.logger.name, options) for entry in entries]
+        pool = multiprocessing.Pool(min(self.jobs, len(entries)), _init_worker)
+        try:
+            for result, stats in pool.imap(_parse_entry_worker, args):
+                if stats is not None:
+                    STATS.merge(stats)
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Yield the results of parse_entry() for all the entries. Results are
+    # loaded from self.cache when possible, the other entries are parsed
+    # (in parallel if self.jobs > 1) and saved to the cache.
+    def iter_parsed_entries(self, entries):
+        keys = [None] * len(entries)
+        cached = [False] * len(entries)
+        if self.cache is not None:
+            for i in range(len(entries)):
+                keys[i] = self.cache.key(entries[i], self.extract)
+                cached[i] = self.cache.has(keys[i])
+        missing = [entries[i] for i in range(len(entries)) if not cached[i]]
+        if self.jobs > 1 and len(missing) > 1:
+            parsed = self.iter_entries_parallel(missing)
+        else:
+            parsed = (self.parse_entry(entry) for entry in missing)
+        for i in range(len(entries)):
+            # Cached results are only loaded when their turn comes, so that
+            # one entry at a time is in memory
+            result = None
+            if cached[i]:
+                result = self.cache.get(keys[i])
+            if result is None:
+                if cached[i]:
+                    # Broken or evicted meanwhile
+                    result = self.parse_entry(entries[i])
+                else:
+                    result = next(parsed)
+                if self.cache is not None:
+                    self.cache.put(keys[i], result)
+            yield result
+
+    # Parse the tarballs or dirs in self.path and yield the testsuites one
+    # by one. Only the statistics are kept in self.data, the testsuites are
+    # left to the caller.
+    def iter_testsuites(self):
+        entries = self.entries
+        if entries is None:
+            with STATS.stage('discovery'):
+                entries = glob.glob(os.path.join(self.path, '*'))
+        # Ids start from 0 for each log dir, even when called again in process
+        TestsuiteParser.ID = 0
+        duplicates = {}
+        if self.dedup != 'off':
+            duplicates = self.find_duplicates(entries)
+        if self.dedup == 'drop':
+            entries = [entry for entry in entries if entry not in duplicates]
+            duplicates = {}
+        # Testsuites of the entries having duplicates, originals come first
+        originals = set(duplicates.values())
+        # An original may yield no testsuite, e.g. a corrupt tarball
+        kept = dict((entry, []) for entry in originals)  # {<original entry>: [<testsuite>]}
+        parsed = None
+        if self.jobs > 1 or self.cache is not None:
+            parsed = self.iter_parsed_entries([entry for entry in entries
+                                                if entry not in duplicates])
+        for entry in entries:
+            if entry in duplicates:
+                testsuites = self.copy_testsuites(kept[duplicates[entry]])
+            elif parsed is None:
+                testsuites = self.iter_entry(entry)
+            else:
+                testsuites, count = next(parsed)
+                for testsuite in testsuites:
+                    testsuite.id += TestsuiteParser.ID
+                TestsuiteParser.ID += count
+            for testsuite in testsuites:
+                if entry in originals:
+                    kept[entry].append(testsuite)
+                if self.budget is not None and entry not in duplicates:
+                    self.budget.hold(testsuite)
+                self.add_statistics(testsuite)
+                yield testsuite
+
+    # Parse all the tarballs or dirs in self.path
+    def parse(self):
+        for testsuite in self.iter_testsuites():
+            self.data.testsuites.append(testsuite)
         return self.data
 
+# Leave SIGINT to the main process and make sure pool.terminate() kills the
+# workers, even if the main process installed its own handlers(--watch)
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Drop the stats inherited from the main process
+    STATS.reset()
+
+# Parse one entry of a log dir in a worker process.
+# Return (<result of TestsuitesParser.parse_entry()>, <STATS.take() or None>)
+def _parse_entry_worker(args):
+    name, path, entry, logger_name, options = args
+    p = TestsuitesParser(name, path, logging.getLogger(logger_name), **options)
+    result = p.parse_entry(entry)
+    return result, STATS.take() if STATS.enabled else None
+
+
+# Return [(<relative file path>, <size>, <mtime>)] for the files of a
+# tarball or dir, it changes whenever any of the files does
+def stat_entry(entry):
+    if not os.path.isdir(entry):
+        st = os.stat(entry)
+        return [('', st.st_size, st.st_mtime)]
+    stats = []
+    for root, dirs, files in os.walk(entry):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            stats.append((os.path.relpath(os.path.join(root, name), entry),
+                        st.st_size, st.st_mtime))
+    return stats
+
+
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# Return a cheap fingerprint of a tarball: its size and the hash of a few
+# blocks(start, middle and end) of it. Same content gives the same
+# fingerprint, a different one means different content.
+def sample_fingerprint(tarball, block_size=FINGERPRINT_BLOCK_SIZE):
+    h = hashlib.sha1()
+    with file(tarball, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update("%d\0" % (size))
+        for offset in sorted(set([0, max(0, size / 2 - block_size / 2),
+                                    max(0, size - block_size)])):
+            f.seek(offset)
+            data = f.read(block_size)
+            STATS.add_read(len(data), files=0)
+            h.update(data)
+    return h.hexdigest()
+
+# Return the hash of the whole content of a tarball, for tarballs having
+# the same sample_fingerprint()
+def full_fingerprint(tarball, block_size=FINGERPRINT_BLOCK_SIZE):
+    h = hashlib.sha1()
+    with file(tarball, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            STATS.add_read(len(data), files=0)
+            h.update(data)
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    '''
+    On-disk cache of parsed log tarballs/dirs.
+
+    Each entry is pickled to <path>/<sha1 of key>.pickle. The key is made
+    of the tarball/dir path, the size and mtime of its files and the parser
+    settings, so changed inputs are parsed again. The least recently used
+    entries are removed when the cache grows over max_size bytes.
+    '''
+    VERSION     = 3
+    DEFAULT_DIR = '~/.cache/junit_xml_gen'
+    MAX_SIZE    = 256 * 1024 * 1024
+    SUFFIX      = '.pickle'
+
+    # rebuild: Ignore cached entries, fresh results still get saved
+    def __init__(self, path=DEFAULT_DIR, max_size=MAX_SIZE, rebuild=False, logger=None):
+        self.path = expand_path(path)
+        self.max_size = max_size
+        self.rebuild = rebuild
+        if logger is None:
+            self.logger = logging.getLogger(self.__class__.__name__)
+        else:
+            self.logger = logger
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0755)
+
+    # Return the cache key of a tarball or dir
+    # settings: Other parser settings changing the results
+    def key(self, entry, *settings):
+        entry = expand_path(entry)
+        items = [ParseCache.VERSION, TestcaseParser.LINE_COUNT, TestcaseParser.MAX_LINE_BYTES,
+                TestcaseParser.MAX_BYTES, entry, settings]
+        items.extend(stat_entry(entry))
+        return hashlib.sha1(repr(items)).hexdigest()
+
+    def get_cache_file(self, key):
+        return os.path.join(self.path, key + ParseCache.SUFFIX)
+
+    # Return whether key may be cached, without loading it
+    def has(self, key):
+        return not self.rebuild and os.path.isfile(self.get_cache_file(key))
+
+    # Return the cached value or None
+    def get(self, key):
+        if self.rebuild:
+            return None
+        cache_file = self.get_cache_file(key)
+        try:
+            with STATS.stage('cache'), file(cache_file, 'rb') as f:
+                value = pickle.load(f)
+                STATS.add_read(f.tell())
+        except IOError, e:
+            return None
+        except Exception, e:
+            self.logger.warning("Removing broken cache file %s: %s" % (cache_file, e))
+            self.remove(cache_file)
+            return None
+        # Update mtime for LRU eviction
+        try:
+            os.utime(cache_file, None)
+        except OSError, e:
+            pass
+        return value
+
+    def put(self, key, value):
+        cache_file = self.get_cache_file(key)
+        tmp_file = "%s.%s.tmp" % (cache_file, uuid.uuid4())
+        try:
+            with file(tmp_file, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError), e:
+            self.logger.warning("Unable to write cache file %s: %s" % (cache_file, e))
+            self.remove(tmp_file)
+            return
+        self.evict()
+
+    def remove(self, cache_file):
+        try:
+            os.remove(cache_file)
+        except OSError, e:
+            pass
+
+    # Remove the least recently used entries until the cache fits max_size
+    def evict(self):
+        entries = []
+        total = 0
+        for cache_file in glob.glob(os.path.join(self.path, '*' + ParseCache.SUFFIX)):
+            try:
+                st = os.stat(cache_file)
+            except OSError, e:
+                continue
+            entries.append((st.st_mtime, st.st_size, cache_file))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, cache_file in entries:
+            if total <= self.max_size:
+                break
+            self.logger.debug("Evicting cache file %s" % (cache_file))
+            self.remove(cache_file)
+            total -= size
+
+
+class DirWatcher(object):
+    '''
+    Wait for files to be added, changed or removed under some directories.
+
+    inotify is used if pyinotify is installed, otherwise the tarballs/dirs
+    of the directories are stat'ed every time wait() is called.
+    '''
+    INTERVAL    = 5
+    EVENTS      = ['IN_CREATE', 'IN_DELETE', 'IN_CLOSE_WRITE', 'IN_MOVED_TO', 'IN_MOVED_FROM']
+
+    def __init__(self, paths, logger=None):
+        self.paths = paths
+        if logger is None:
+            self.logger = logging.getLogger(self.__class__.__name__)
+        else:
+            self.logger = logger
+        self.notifier = None
+        self.changed = False
+        self.snapshot = None
+        if pyinotify is not None:
+            try:
+                self.start_inotify()
+            except Exception, e:
+                # e.g. Out of inotify watches
+                self.logger.warning("Unable to use inotify, polling instead: %s" % (e))
+                self.notifier = None
+        if self.notifier is None:
+            self.snapshot = self.take_snapshot()
+
+    def start_inotify(self):
+        wm = pyinotify.WatchManager()
+        mask = 0
+        for event in self.EVENTS:
+            mask |= getattr(pyinotify, event)
+        for path in self.paths:
+            wm.add_watch(path, mask, rec=True, auto_add=True, quiet=False)
+        self.notifier = pyinotify.Notifier(wm, default_proc_fun=self.on_event)
+
+    def on_event(self, event):
+        self.changed = True
+
+    # Return {<tarball or dir>: stat_entry()} for all the watched directories
+    def take_snapshot(self):
+        snapshot = {}
+        for path in self.paths:
+            for entry in glob.glob(os.path.join(path, '*')):
+                try:
+                    snapshot[entry] = stat_entry(entry)
+                except OSError, e:
+                    # Removed meanwhile
+                    continue
+        return snapshot
+
+    # Wait up to timeout seconds. Return True if something changed since
+    # the last call
+    def wait(self, timeout=INTERVAL):
+        if self.notifier is None:
+            time.sleep(timeout)
+            snapshot = self.take_snapshot()
+            changed = snapshot != self.snapshot
+            self.snapshot = snapshot
+            return changed
+        if self.notifier.check_events(timeout * 1000):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed = self.changed
+        self.changed = False
+        return changed
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+
 class BaseElement(object):
     ATTR_BLACKLIST = ['system-out', 'system-err',
                         'submission_id', 'submission_link']
 
     def __init__(self, data, tag, parent=None):
         self.data = data
+        self.parent = parent
         self.elem = ET.Element(tag)
         if parent is not None:
             parent.append(self)
@@ -495,7 +1694,8 @@ class BaseElement(object):
                 self.elem.set(k, v)
 
     def to_pretty_xml(self, encoding='UTF-8'):
-        return ET.tostring(self.elem, encoding=encoding, method='xml')
+        with patched_element_tree():
+            return ET.tostring(self.elem, encoding=encoding, method='xml')
 
 
 class TestcaseElement(BaseElement):
@@ -505,34 +1705,48 @@ class TestcaseElement(BaseElement):
                                             parent)
         self.convert()
 
+    # Testcases of a testsuite share the same encoding cache
+    def get_source(self):
+        if self.parent is None:
+            return None
+        return self.parent.data.name
+
+    # Return (submission id, submission link) of the testcase or its testsuite
+    def get_submission(self):
+        if self.data.submission_id and self.data.submission_link:
+            return self.data.submission_id, self.data.submission_link
+        if self.parent is not None:
+            return self.parent.data.submission_id, self.parent.data.submission_link
+        return None, None
+
     def convert_submission_data(self):
-        if not(self.data.get('submission_id', None) and
-                self.data.get('submission_link', None)):
+        submission_id, submission_link = self.get_submission()
+        if not(submission_id and submission_link):
             return
-        text = "Submission ID %s: %s" % (self.data['submission_id'],
-                                        self.data['submission_link'])
+        text = "Submission ID %s: %s" % (submission_id, submission_link)
         # Write submission data into "system-err"
         err_elem = ET.SubElement(self.elem, 'system-err')
-        cdata_elem = CDATA(text)
+        cdata_elem = CDATA(text, self.get_source())
         err_elem.append(cdata_elem)
 
     def convert(self):
         self.set_attrs()
         self.convert_submission_data()
         # skipped
-        if self.data['skipped'] is not None:
+        if self.data.skipped is not None:
             skip_elem = ET.SubElement(self.elem, 'skipped')
-            skip_elem.text = self.data['skipped']
+            skip_elem.text = self.data.skipped
         # failure & error
         for key in ['failure', 'error']:
-            if self.data[key] is not None:
+            value = getattr(self.data, key)
+            if value is not None:
                 elem = ET.SubElement(self.elem, key)
                 for attr in ['type', 'message']:
-                    elem.set(attr, self.data[key][attr])
-                elem.text = self.data[key]['text']
+                    elem.set(attr, value[attr])
+                elem.text = value['text']
         # system-out
         out_elem = ET.SubElement(self.elem, 'system-out')
-        cdata_elem = CDATA(self.data['system-out'])
+        cdata_elem = CDATA(get_log_text(self.data.system_out), self.get_source())
         out_elem.append(cdata_elem)
 
 
@@ -545,7 +1759,7 @@ class TestsuiteElement(BaseElement):
 
     def convert(self):
         self.set_attrs()
-        for testcase_data in self.data['testcases']:
+        for testcase_data in self.data.testcases:
             TestcaseElement(testcase_data, parent=self)
 
 
@@ -558,60 +1772,529 @@ class TestsuitesElement(BaseElement):
 
     def convert(self):
         self.set_attrs()
-        for testsuite_data in self.data['testsuites']:
+        for testsuite_data in self.data.testsuites:
             TestsuiteElement(testsuite_data, parent=self)
 
 
+# Escape text and attribute values like xml.etree.ElementTree does
+def escape_xml_text(text, encoding):
+    if isinstance(text, str):
+        text = str_to_unicode(text)
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+def escape_xml_attrib(text, encoding):
+    if isinstance(text, str):
+        text = str_to_unicode(text)
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    text = text.replace('"', '&quot;').replace('\n', '&#10;')
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
+class OutputWriter(object):
+    '''
+    Base class of output formats.
+
+    The testsuites are written one by one with write_testsuite(), between
+    write_start() and write_end(). Formats needing the totals before the
+    testsuites set TOTALS_FIRST, their testsuites are then spooled by
+    JunitConverter.stream() until the totals are known.
+    '''
+    TOTALS_FIRST = False
+
+    def __init__(self, file_like_or_io, encoding='UTF-8'):
+        self.write = file_like_or_io.write
+        self.encoding = encoding
+
+    # testsuites: TestsuitesRecord. Its testsuites list may be empty when
+    #             streaming, empty tells if any testsuite will be written
+    def write_start(self, testsuites, empty=False):
+        pass
+
+    def write_testsuite(self, testsuite):
+        raise NotImplementedError()
+
+    def write_end(self, testsuites):
+        pass
+
+    def write_testsuites(self, testsuites):
+        self.write_start(testsuites, empty=not testsuites.testsuites)
+        for testsuite in testsuites.testsuites:
+            self.write_testsuite(testsuite)
+        self.write_end(testsuites)
+
+
+class JunitWriter(OutputWriter):
+    '''
+    Write records as junit xml straight to a file object, without building
+    ElementTree objects. The output is the same as TestsuitesElement's.
+    '''
+    TOTALS_FIRST = True
+    INDENT = '  '
+    # Characters that need escaping or encoding in attribute values
+    SPECIAL_ATTRIB_CHARS = re.compile(r'[&<>"\n\x80-\xff]')
+
+    def __init__(self, file_like_or_io, encoding='UTF-8'):
+        super(JunitWriter, self).__init__(file_like_or_io, encoding)
+        self.empty = False
+        # Plain ASCII strings can be written as they are
+        self.ascii_compatible = (u'<a>'.encode(encoding) == '<a>')
+        self.attr_fields = {}   # {<Record class>: [(<key>, <attribute name>)]}
+
+    def escape_attrib(self, text):
+        if (self.ascii_compatible and isinstance(text, str) and
+                JunitWriter.SPECIAL_ATTRIB_CHARS.search(text) is None):
+            return text
+        return escape_xml_attrib(text, self.encoding)
+
+    # Same rule as ElementTree.write()
+    def write_declaration(self):
+        if self.encoding not in ('utf-8', 'us-ascii'):
+            self.write("<?xml version='1.0' encoding='%s'?>\n" % (self.encoding))
+
+    # Return the (key, value) pairs of a record sorted by key
+    def get_sorted_items(self, record):
+        if not isinstance(record, Record):
+            return sorted(record.items())
+        fields = self.attr_fields.get(record.__class__)
+        if fields is None:
+            fields = sorted((k, k.replace('-', '_')) for k in record.FIELDS
+                            if k not in BaseElement.ATTR_BLACKLIST)
+            self.attr_fields[record.__class__] = fields
+        return [(k, getattr(record, attr)) for k, attr in fields]
+
+    # Return the ' key="value"' string of a record, see BaseElement.set_attrs()
+    def format_attrs(self, record):
+        attrs = []
+        for k, v in self.get_sorted_items(record):
+            if (isinstance(v, list) or
+                    isinstance(v, dict) or
+                    v is None or
+                    k in BaseElement.ATTR_BLACKLIST):
+                continue
+            if not isinstance(v, basestring):
+                v = str(v)
+            attrs.append(' %s="%s"' % (k, self.escape_attrib(v)))
+        return ''.join(attrs)
+
+    # Append a CDATA section inside a <tag> element to parts
+    def format_cdata(self, parts, tag, text, level, source=None):
+        text = str_to_unicode(escape_cdata_text(text or ''), source).encode(self.encoding)
+        indent = self.INDENT * level
+        parts.append('%s<%s>\n<![CDATA[%s\n]]>\n%s</%s>\n' % (indent, tag, text, indent, tag))
+
+    # testsuite: The TestsuiteRecord of the testcase, if any
+    def write_testcase(self, testcase, level=2, testsuite=None):
+        indent = self.INDENT * (level + 1)
+        source = None
+        submission_id, submission_link = testcase.submission_id, testcase.submission_link
+        if testsuite is not None:
+            source = testsuite.name
+            if not(submission_id and submission_link):
+                submission_id, submission_link = testsuite.submission_id, testsuite.submission_link
+        parts = ['%s<testcase%s>\n' % (self.INDENT * level, self.format_attrs(testcase))]
+        if submission_id and submission_link:
+            text = "Submission ID %s: %s" % (submission_id, submission_link)
+            self.format_cdata(parts, 'system-err', text, level + 1, source)
+        if testcase.skipped is not None:
+            parts.append('%s<skipped>%s</skipped>\n' % (indent, escape_xml_text(testcase.skipped,
+                                                                                self.encoding)))
+        for key in ['failure', 'error']:
+            value = getattr(testcase, key)
+            if value is not None:
+                parts.append('%s<%s message="%s" type="%s">%s</%s>\n' % (
+                            indent, key,
+                            self.escape_attrib(value['message']),
+                            self.escape_attrib(value['type']),
+                            escape_xml_text(value['text'], self.encoding),
+                            key))
+        self.format_cdata(parts, 'system-out', get_log_text(testcase.system_out), level + 1, source)
+        parts.append('%s</testcase>\n' % (self.INDENT * level))
+        self.write(''.join(parts))
+
+    def write_testsuite(self, testsuite, level=1):
+        indent = self.INDENT * level
+        attrs = self.format_attrs(testsuite)
+        if not testsuite.testcases:
+            self.write('%s<testsuite%s />\n' % (indent, attrs))
+            return
+        self.write('%s<testsuite%s>\n' % (indent, attrs))
+        for testcase in testsuite.testcases:
+            self.write_testcase(testcase, level + 1, testsuite)
+        self.write('%s</testsuite>\n' % (indent))
+
+    # Write the declaration and the <testsuites> start tag.
+    # empty: Write an empty element instead, there won't be any testsuite
+    def write_start(self, testsuites, empty=False):
+        self.empty = empty
+        self.write_declaration()
+        if empty:
+            self.write('<testsuites%s />\n' % (self.format_attrs(testsuites)))
+        else:
+            self.write('<testsuites%s>\n' % (self.format_attrs(testsuites)))
+
+    def write_end(self, testsuites):
+        if not self.empty:
+            self.write('</testsuites>\n')
+
+
+# Convert a record value to something json can dump. Raw strings are
+# decoded, they may not be UTF-8.
+def to_json_value(value, source=None):
+    value = get_log_text(value)
+    if isinstance(value, str):
+        return str_to_unicode(value, source)
+    if isinstance(value, dict):
+        return dict((k, to_json_value(v, source)) for k, v in value.items())
+    return value
+
+
+class JsonLinesWriter(OutputWriter):
+    '''
+    Write one json object per line: a "testsuite" record followed by its
+    "testcase" records, and a "testsuites" record with the totals at the end.
+    Every record has a "type" key. Testcases carry their testsuite name and
+    all the TestcaseRecord fields, including the log.
+    '''
+
+    def write_record(self, record_type, record, source=None, **extra):
+        obj = {'type': record_type}
+        for k, v in record.items():
+            if not isinstance(v, list):
+                obj[k] = to_json_value(v, source)
+        obj.update(extra)
+        self.write(json.dumps(obj, sort_keys=True, separators=(',', ':')))
+        self.write('\n')
+
+    def write_testsuite(self, testsuite):
+        self.write_record('testsuite', testsuite)
+        for testcase in testsuite.testcases:
+            submission = {}
+            if not(testcase.submission_id and testcase.submission_link):
+                submission = {'submission_id'   : testsuite.submission_id,
+                            'submission_link'   : testsuite.submission_link}
+            self.write_record('testcase', testcase, testsuite.name,
+                            testsuite=testsuite.name, **submission)
+
+    def write_end(self, testsuites):
+        self.write_record('testsuites', testsuites)
+
+
+class SummaryWriter(OutputWriter):
+    '''
+    Write the totals of every testsuite as a single json document, small
+    enough to be loaded right away by dashboards:
+
+        {"testsuites": [[<name>, <id>, <tests>, <failures>, ...], ...],
+         "columns": ["name", "id", "tests", "failures", ...],
+         "name": <test name>, "tests": <total>, "failures": <total>, ...}
+    '''
+    COLUMNS = ['name', 'id', 'tests', 'failures', 'errors', 'skipped', 'time',
+                'timestamp', 'submission_id']
+    TOTALS = ['name', 'tests', 'failures', 'errors', 'skipped', 'time']
+
+    def write_start(self, testsuites, empty=False):
+        self.count = 0
+        self.write('{"testsuites":[')
+
+    def write_testsuite(self, testsuite):
+        row = [to_json_value(getattr(testsuite, column)) for column in self.COLUMNS]
+        if self.count > 0:
+            self.write(',')
+        self.write(json.dumps(row, separators=(',', ':')))
+        self.count += 1
+
+    def write_end(self, testsuites):
+        totals = dict((key, to_json_value(getattr(testsuites, key))) for key in self.TOTALS)
+        totals['columns'] = self.COLUMNS
+        self.write('],')
+        self.write(json.dumps(totals, sort_keys=True, separators=(',', ':'))[1:])
+        self.write('\n')
+
+
+# Output format name => OutputWriter class
+OUTPUT_FORMATS = collections.OrderedDict([('xml',     JunitWriter),
+                                          ('jsonl',   JsonLinesWriter),
+                                          ('summary', SummaryWriter)])
+
+
 class JunitConverter(object):
     '''
     Convert testsuites data to junit format
     '''
-    def __init__(self, name, log_dir, submission_dir=None, encoding='UTF-8', logger=None):
+    # entries, dedup: See TestsuitesParser
+    def __init__(self, name, log_dir, submission_dir=None, encoding='UTF-8', logger=None, jobs=1,
+                extract=True, cache=None, entries=None, dedup='keep'):
         self.name = name
+        self.jobs = jobs
+        self.extract = extract
+        self.cache = cache
+        self.entries = entries
+        self.dedup = dedup
         self.log_dir = expand_path(log_dir)
         if submission_dir is not None:
             submission_dir = expand_path(submission_dir)
         self.submission_dir = submission_dir
-        self.root = None
+        self.data = None
         self.encoding = encoding
-        self.logger = logger
+        if logger is None:
+            self.logger = logging.getLogger(self.__class__.__name__)
+        else:
+            self.logger = logger
 
     def __str__(self):
-        return self.root.to_pretty_xml(self.encoding)
+        output = StringIO.StringIO()
+        self.dump(output)
+        return output.getvalue()
 
     def set_encoding(self, encoding):
         self.encoding = encoding
 
+    # Parse submission files. Return None if there's no submission dir
+    # names: Only parse the submissions of these testsuites. None for all
+    def parse_submissions(self, names=None):
+        if self.submission_dir is None:
+            return None
+        submission_parser = SubmissionParser(self.submission_dir, self.logger)
+        submission_parser.parse(names)
+        return submission_parser.get_result()
+
+    # Add submission id and link to a testsuite, they apply to all its testcases
+    # submission_data: SubmissionParser result, indexed by testsuite name, or
+    #                  a SubmissionParser to parse the files on demand
+    def add_submission_data(self, testsuite, submission_data):
+        d = submission_data.get(testsuite.name)
+        if not d:
+            self.logger.warning("No submission data for testsuite %s" % (testsuite.name))
+            return
+        submission_id = d.get('id', None)
+        submission_link = d.get('link', None)
+        if submission_id and submission_link:
+            testsuite.submission_id = submission_id
+            testsuite.submission_link = submission_link
+
     def run(self):
-        # Parse log files
-        log_parser = TestsuitesParser(self.name, self.log_dir, self.logger)
+        # Parse log files. All testcase logs are kept until dump(), within
+        # the limits of LOG_BUDGET
+        LOG_BUDGET.reset()
+        log_parser = TestsuitesParser(self.name, self.log_dir, self.logger,
+                                    jobs=self.jobs, extract=self.extract, cache=self.cache,
+                                    entries=self.entries, dedup=self.dedup, budget=LOG_BUDGET)
         log_parser.parse()
         log_data = log_parser.get_result()
-        # Parse submission files
+        # Parse submission files of these testsuites only
+        submission_data = self.parse_submissions(set(t.name for t in log_data.testsuites))
+        if submission_data is not None:
+            for testsuite in log_data.testsuites:
+                self.add_submission_data(testsuite, submission_data)
+        self.data = log_data
+
+    # Return [(<OutputWriter class>, <file object>)]
+    # outputs: A file object for xml output, or [(<format name>, <file object>)]
+    def get_writers(self, outputs):
+        if hasattr(outputs, 'write'):
+            outputs = [('xml', outputs)]
+        return [(OUTPUT_FORMATS[fmt], f) for fmt, f in outputs]
+
+    # Write the data parsed by run()
+    # outputs: See get_writers()
+    def dump(self, outputs):
+        for writer_class, f in self.get_writers(outputs):
+            with STATS.stage('write'):
+                writer_class(f, self.encoding).write_testsuites(self.data)
+
+    # Parse, convert and write testsuites one at a time, so the whole data
+    # is never kept in memory. All the outputs are written in the same pass.
+    # The totals are only known at the end, so for formats needing them
+    # first(e.g. xml) the testsuites are spooled to a temporary file and
+    # copied to the output right after the start.
+    # outputs: See get_writers()
+    def stream(self, outputs):
+        log_parser = TestsuitesParser(self.name, self.log_dir, self.logger,
+                                    jobs=self.jobs, extract=self.extract, cache=self.cache,
+                                    entries=self.entries, dedup=self.dedup)
+        # Testsuite names are unknown yet, submissions are parsed on demand
+        submission_data = None
         if self.submission_dir is not None:
-            submission_parser = SubmissionParser(self.submission_dir, self.logger)
-            submission_parser.parse()
-            submission_data = submission_parser.get_result()
-            # Add submission id and link to log_data
-            for testsuite in log_data['testsuites']:
-                d = {}
-                for k, v in submission_data.items():
-                    if k == testsuite['name']:
-                        d = v
-                if len(d) == 0:
-                    self.logger.warning("No submission data for testsuite %s" % (testsuite['name']))
-                    continue
-                submission_id = d.get('id', None)
-                submission_link = d.get('link', None)
-                if submission_id and submission_link:
-                    for testcase in testsuite['testcases']:
-                        testcase['submission_id'] = submission_id
-                        testcase['submission_link'] = submission_link
-        # Create xml tree 
-        self.root = TestsuitesElement(log_data)
-
-    def dump(self, file_like_or_io):
-        file_like_or_io.write(str(self))
+            submission_data = SubmissionParser(self.submission_dir, self.logger)
+        writers = []    # [(<writer>, <file object>, <spool or None>)]
+        try:
+            for writer_class, f in self.get_writers(outputs):
+                spool = None
+                if writer_class.TOTALS_FIRST:
+                    spool = tempfile.TemporaryFile()
+                    writer = writer_class(spool, self.encoding)
+                else:
+                    writer = writer_class(f, self.encoding)
+                    writer.write_start(log_parser.get_result())
+                writers.append((writer, f, spool))
+            count = 0
+            for testsuite in log_parser.iter_testsuites():
+                if submission_data is not None:
+                    self.add_submission_data(testsuite, submission_data)
+                with STATS.stage('write'):
+                    for writer, f, spool in writers:
+                        writer.write_testsuite(testsuite)
+                count += 1
+            log_data = log_parser.get_result()
+            for writer, f, spool in writers:
+                with STATS.stage('write'):
+                    if spool is not None:
+                        writer = writer.__class__(f, self.encoding)
+                        writer.write_start(log_data, empty=(count == 0))
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, f)
+                    writer.write_end(log_data)
+        finally:
+            for writer, f, spool in writers:
+                if spool is not None:
+                    spool.close()
+
+    # Write self.data to files. Each file is written to a temporary file
+    # first and renamed, so readers never see a partial one.
+    # outputs: [(<format name>, <file path>)]
+    # raise_errors: Raise the write errors once the temporary file is
+    #   removed, instead of only logging them
+    def dump_files(self, outputs, raise_errors=False):
+        for writer_class, path in self.get_writers(outputs):
+            tmp_file = "%s.%s.tmp" % (path, uuid.uuid4())
+            try:
+                with STATS.stage('write'), file(tmp_file, 'w') as f:
+                    writer_class(f, self.encoding).write_testsuites(self.data)
+                os.rename(tmp_file, path)
+            except (IOError, OSError), e:
+                exc_info = sys.exc_info()
+                self.logger.error("Unable to write %s: %s" % (path, e))
+                try:
+                    os.remove(tmp_file)
+                except OSError, e:
+                    pass
+                if raise_errors:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+    # Parse the new and changed tarballs/dirs of the log dir.
+    # A tarball/dir is only parsed once it's the same as in the previous
+    # call, so the ones still being copied are left for later.
+    # parsed: {<entry>: (<stat_entry()>, <parse_entry() result>)}, updated
+    # stats: {<entry>: <stat_entry()>} of the previous call, updated
+    # force: Parse the entries still changing too
+    # Return (<parsed changed>, <some entries are still changing>)
+    def update_entries(self, log_parser, parsed, stats, force=False):
+        last_stats = dict(stats)
+        stats.clear()
+        for entry in glob.glob(os.path.join(self.log_dir, '*')):
+            try:
+                stats[entry] = stat_entry(entry)
+            except OSError, e:
+                # Removed meanwhile
+                continue
+        pending = False
+        entries = []
+        for entry, st in stats.items():
+            if entry in parsed and parsed[entry][0] == st:
+                continue
+            if not force and last_stats.get(entry) != st:
+                pending = True
+                continue
+            entries.append(entry)
+        removed = [entry for entry in parsed if entry not in stats]
+        for entry in removed:
+            self.logger.info("Removed %s" % (entry))
+            self.release_logs(parsed.pop(entry)[1])
+        for entry, result in zip(entries, log_parser.iter_parsed_entries(entries)):
+            self.logger.info("Parsed %s" % (entry))
+            if entry in parsed:
+                self.release_logs(parsed[entry][1])
+            # The parsed results are kept for the whole watch, the testcase
+            # logs are subject to LOG_BUDGET as in run()
+            for testsuite in result[0]:
+                LOG_BUDGET.hold(testsuite)
+            parsed[entry] = (stats[entry], result)
+        return bool(entries or removed), pending
+
+    # Stop counting the logs of a parse_entry() result in LOG_BUDGET
+    def release_logs(self, result):
+        for testsuite in result[0]:
+            LOG_BUDGET.release(testsuite)
+
+    # Build self.data from the results of update_entries(). Testsuite ids
+    # are numbered in the same order as in run()
+    def build_data(self, stats, parsed):
+        log_parser = TestsuitesParser(self.name, self.log_dir, self.logger)
+        log_data = log_parser.get_result()
+        submission_data = None
+        if self.submission_dir is not None:
+            submission_data = SubmissionParser(self.submission_dir, self.logger)
+        start_id = 0
+        for entry in glob.glob(os.path.join(self.log_dir, '*')):
+            if entry not in parsed or entry not in stats:
+                continue
+            testsuites, count = parsed[entry][1]
+            for testsuite in testsuites:
+                # Parsed results are kept as they are for the next builds
+                testsuite = testsuite.copy()
+                testsuite.id += start_id
+                if submission_data is not None:
+                    self.add_submission_data(testsuite, submission_data)
+                log_parser.add_statistics(testsuite)
+                log_data.testsuites.append(testsuite)
+            start_id += count
+        self.data = log_data
+
+    # Watch the log and submission dirs and rewrite the output files each
+    # time something changes, so partial results can be read during a run.
+    # Only the new or changed tarballs/dirs are parsed. Return on SIGINT or
+    # SIGTERM, after parsing everything one last time.
+    # outputs: [(<format name>, <file path>)]
+    # interval: Seconds between checks of the dirs
+    def watch(self, outputs, interval=DirWatcher.INTERVAL):
+        log_parser = TestsuitesParser(self.name, self.log_dir, self.logger,
+                                    jobs=self.jobs, extract=self.extract, cache=self.cache)
+        paths = [self.log_dir]
+        if self.submission_dir is not None:
+            paths.append(self.submission_dir)
+        watcher = DirWatcher(paths, self.logger)
+        stopped = []
+        def stop(signum, frame):
+            stopped.append(signum)
+        handlers = [(signum, signal.signal(signum, stop)) for signum in (signal.SIGINT, signal.SIGTERM)]
+        parsed = {}
+        stats = {}
+        LOG_BUDGET.reset()
+        try:
+            self.logger.info("Watching %s" % (', '.join(paths)))
+            # Tarballs/dirs already there are parsed right away
+            changed, pending = self.update_entries(log_parser, parsed, stats, force=True)
+            dirty = True
+            while True:
+                if changed or dirty:
+                    self.build_data(stats, parsed)
+                    self.dump_files(outputs)
+                if stopped:
+                    break
+                dirty = watcher.wait(interval)
+                changed = False
+                if dirty or pending or stopped:
+                    changed, pending = self.update_entries(log_parser, parsed, stats,
+                                                        force=bool(stopped))
+            self.logger.info("Stopped watching")
+        finally:
+            watcher.close()
+            for signum, handler in handlers:
+                signal.signal(signum, handler)
+
+
+# Parse the logs of log_dir and write them to files. Return the parsed
+# TestsuitesRecord, raise IOError/OSError if a file can't be written.
+# This is what the command line does, for callers importing this module
+# instead of running it.
+# outputs: [(<format name>, <file path>)], see OUTPUT_FORMATS
+# kwargs: Other JunitConverter options, e.g. submission_dir, entries, jobs
+def generate(name, log_dir, outputs, **kwargs):
+    converter = JunitConverter(name, log_dir, **kwargs)
+    converter.run()
+    converter.dump_files(outputs, raise_errors=True)
+    return converter.data
 
 
 if __name__ == '__main__':
@@ -625,7 +2308,37 @@ if __name__ == '__main__':
     -n|--name           (Required)Name of this test(e.g.Kernel Regression, Userspace, Acceptance)
     -s|--submission     Log submission dir. Default: /var/log/qaset/submission
     -o|--output         Write xml to file instead of STDOUT
+    -f|--format         Output format: xml, jsonl or summary. Default: xml
+                        Use FORMAT:FILE to write another format to FILE in the same run.
+                        Can be given multiple times, e.g. -f xml -f summary:summary.json
     -d|--debug          Enable debug mode
+    -j|--jobs           Parse tarballs/dirs with N processes. Default: 1
+    --detect-size       Bytes used to detect log encoding, 0 for all. Default: 65536
+    -c|--cache          Cache parsed tarballs/dirs in DIR and reuse them if unchanged
+    --cache-size        Max cache size in MB. Default: 256
+    --rebuild-cache     Parse everything again and refresh the cache
+    --no-extract        Read tarballs in process instead of extracting them to /tmp
+    --dedup             What to do with tarballs identical to another one:
+                        keep: parse once, output the testsuites of every copy
+                        drop: parse once, output the testsuites of the first copy only
+                        off: parse every copy. Default: keep
+    --stream            Write testsuites as soon as they're parsed to keep memory usage low
+    --watch             Keep running and rewrite the output files whenever tarballs/dirs or
+                        submissions are added, until SIGINT/SIGTERM. Needs -o or FORMAT:FILE.
+                        Uses inotify if pyinotify is installed, polling otherwise.
+    --interval          Seconds between checks of the dirs in --watch mode. Default: 5
+    --stats             Print time, bytes/files read and peak memory of each stage and
+                        the slowest testsuites to STDERR
+    --stats-top         Number of slowest testsuites printed by --stats. Default: 10
+    --profile           Run with cProfile and save the profile to FILE
+    --tail-lines        Lines of each testcase log to keep. Default: 50
+    --max-line-bytes    Cut longer log lines, 0 for no limit. Default: 65536
+    --max-log-bytes     Keep only the last N bytes of each testcase log, 0 for no limit.
+                        Default: 262144
+    --log-memory        MB of testcase logs kept in memory before writing the output,
+                        0 for no limit. Default: 256
+    --log-overflow      What to do with the logs over --log-memory: spill them to a
+                        temporary file, or truncate them to 1KB. Default: spill
     -e|--encoding       (TBD)Set xml encoding. Default: UTF-8
 '''
     op = OptionParser(usage=usage)
@@ -636,10 +2349,55 @@ if __name__ == '__main__':
                 help='Log submission dir. Default: /var/log/qaset/submission')
     op.add_option('-o', '--output', dest='file', type='string',
                 help='Save xml to file')
+    op.add_option('-f', '--format', action='append', dest='formats', type='string',
+                help='Output format: %s. FORMAT:FILE to write it to FILE' % (', '.join(OUTPUT_FORMATS.keys())))
     op.add_option('-d', '--debug', action="store_true", dest="debug",
                 help='Enable debug mode')
     op.add_option('-e', '--encoding', dest="encoding", default='UTF-8',
                 help='(TBD)Set xml encoding')
+    op.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                help='Parse tarballs/dirs with N processes')
+    op.add_option('--detect-size', dest='detect_size', type='int',
+                default=TextDecoder.SAMPLE_SIZE,
+                help='Bytes used to detect log encoding, 0 for all')
+    op.add_option('-c', '--cache', dest='cache', type='string',
+                help='Cache parsed tarballs/dirs in DIR')
+    op.add_option('--cache-size', dest='cache_size', type='int',
+                default=ParseCache.MAX_SIZE / 1024 / 1024,
+                help='Max cache size in MB')
+    op.add_option('--rebuild-cache', action="store_true", dest='rebuild_cache',
+                help='Parse everything again and refresh the cache')
+    op.add_option('--no-extract', action="store_false", dest='extract', default=True,
+                help='Read tarballs in process instead of extracting them')
+    op.add_option('--dedup', dest='dedup', type='choice', default='keep',
+                choices=TestsuitesParser.DEDUP_MODES,
+                help='keep, drop or off. Default: keep')
+    op.add_option('--stream', action="store_true", dest="stream",
+                help='Write testsuites as soon as they are parsed')
+    op.add_option('--watch', action="store_true", dest="watch",
+                help='Rewrite the output files whenever logs are added')
+    op.add_option('--interval', dest='interval', type='float', default=DirWatcher.INTERVAL,
+                help='Seconds between checks of the dirs in --watch mode')
+    op.add_option('--tail-lines', dest='tail_lines', type='int', default=TestcaseParser.LINE_COUNT,
+                help='Lines of each testcase log to keep')
+    op.add_option('--max-line-bytes', dest='max_line_bytes', type='int',
+                default=TestcaseParser.MAX_LINE_BYTES,
+                help='Cut longer log lines, 0 for no limit')
+    op.add_option('--max-log-bytes', dest='max_log_bytes', type='int',
+                default=TestcaseParser.MAX_BYTES,
+                help='Keep only the last N bytes of each testcase log, 0 for no limit')
+    op.add_option('--log-memory', dest='log_memory', type='int',
+                default=LogBudget.MAX_SIZE / 1024 / 1024,
+                help='MB of testcase logs kept in memory, 0 for no limit')
+    op.add_option('--log-overflow', dest='log_overflow', type='choice', default='spill',
+                choices=LogBudget.OVERFLOW_MODES,
+                help='spill or truncate the logs over --log-memory')
+    op.add_option('--stats', action="store_true", dest="stats",
+                help='Print stage and testsuite statistics')
+    op.add_option('--stats-top', dest='stats_top', type='int', default=10,
+                help='Number of slowest testsuites printed by --stats')
+    op.add_option('--profile', dest='profile', type='string',
+                help='Save a cProfile profile to FILE')
     (options, args) = op.parse_args()
     # Logger
     logging.basicConfig(format='[%(name)s]%(levelname)s: %(message)s')
@@ -650,6 +2408,10 @@ if __name__ == '__main__':
     try:
         assert len(args) == 1
         assert options.name
+        assert options.jobs > 0
+        assert options.interval > 0
+        assert options.tail_lines > 0
+        assert min(options.max_line_bytes, options.max_log_bytes, options.log_memory) >= 0
     except AssertionError, e:
         op.print_usage()
         exit(255)
@@ -660,21 +2422,83 @@ if __name__ == '__main__':
     if not os.path.isdir(submission_dir):
         logger.warning("No submission data. Not a directory: %s." % (submission_dir))
         submission_dir = None
-    # Output file
-    if options.file:
+    # Encoding detection
+    DECODER.sample_size = options.detect_size or None
+    # Testcase log limits
+    TestcaseParser.LINE_COUNT = options.tail_lines
+    TestcaseParser.MAX_LINE_BYTES = options.max_line_bytes or None
+    TestcaseParser.MAX_BYTES = options.max_log_bytes or None
+    LOG_BUDGET.max_size = options.log_memory * 1024 * 1024 or None
+    LOG_BUDGET.overflow = options.log_overflow
+    LOG_BUDGET.logger = logger
+    # Statistics
+    STATS.enabled = options.stats
+    STATS.reset()
+    # Parse cache
+    cache = None
+    if options.cache:
+        cache = ParseCache(options.cache, max_size=options.cache_size * 1024 * 1024,
+                        rebuild=options.rebuild_cache, logger=logger)
+    # Output files: [(<format>, <file name or None for -o/STDOUT>)]
+    formats = []
+    for fmt in options.formats or ['xml']:
+        fmt, sep, path = fmt.partition(':')
+        if fmt not in OUTPUT_FORMATS:
+            logger.error("Unknown output format: %s" % (fmt))
+            exit(255)
+        formats.append((fmt, path or None))
+    if len([path for fmt, path in formats if path is None]) > 1:
+        logger.error("Only one output format can be written to -o/STDOUT")
+        exit(255)
+    formats = [(fmt, path or options.file) for fmt, path in formats]
+    if options.watch and None in [path for fmt, path in formats]:
+        logger.error("--watch needs output files, STDOUT can't be rewritten")
+        exit(255)
+    outputs = []
+    for fmt, path in formats:
+        if options.watch:
+            # Files are replaced after each change
+            outputs.append((fmt, path))
+            continue
+        if path is None:
+            outputs.append((fmt, sys.stdout))
+            continue
         try:
-            outfile = file(options.file, 'w')
+            outputs.append((fmt, file(path, 'w')))
         except Exception, e:
-            logger.error("Failed to create output file %s: %s" % (options.file, e))
-            self.logger.debug(traceback.format_exc())
+            logger.error("Failed to create output file %s: %s" % (path, e))
+            logger.debug(traceback.format_exc())
             exit(1)
-    else:
-        outfile = sys.stdout
     # Convert to xml
     converter = JunitConverter( options.name,
                                 log_dir,
                                 submission_dir=submission_dir,
                                 encoding=options.encoding,
-                                logger=logger)
-    converter.run()
-    converter.dump(outfile)
+                                logger=logger,
+                                jobs=options.jobs,
+                                extract=options.extract,
+                                cache=cache,
+                                dedup=options.dedup)
+    def convert():
+        if options.watch:
+            converter.watch(outputs, options.interval)
+        elif options.stream:
+            converter.stream(outputs)
+        else:
+            converter.run()
+            converter.dump(outputs)
+    if options.profile:
+        # Only the main process is profiled, not the -j workers
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(convert)
+        finally:
+            profiler.dump_stats(options.profile)
+            logger.info("Profile saved to %s" % (options.profile))
+    else:
+        convert()
+    if options.stats:
+        for fmt, f in outputs:
+            if hasattr(f, 'flush'):
+                f.flush()
+        STATS.report(sys.stderr, options.stats_top)
@@ -2,11 +2,13 @@
 import argparse
 import datetime
 import fcntl
+import fnmatch
 import glob
 import os
 import select
 from string import Template
 import subprocess
+import sys
 import threading
 import random
 import re
@@ -140,10 +142,49 @@ def upload_log(log_tarball, upload_url_prefix):
                             succ_msg='Upload succeeded',
                             fail_msg='Upload failed with exit code $exitstatus')
 
-def upload_all_logs(log_dir, upload_url_prefix, pattern='*.tar.*'):
-    for item in glob.glob(os.path.join(log_dir, pattern)):
+# entries: Files of log_dir if already listed
+def upload_all_logs(log_dir, upload_url_prefix, pattern='*.tar.*', entries=None):
+    if entries is None:
+        entries = glob.glob(os.path.join(log_dir, '*'))
+    for item in fnmatch.filter(entries, os.path.join(log_dir, pattern)):
         upload_log(item, upload_url_prefix)
 
+JUNIT_XML_GEN = '/usr/share/qa/qaset/bin/junit_xml_gen.py'
+
+# Generate junit report in process. Fall back to running junit_xml_gen.py
+# if it can't be imported or is an older one without generate()
+# entries: Files of log_dir if already listed
+def generate_junit(log_dir, submission_dir, junit_file, junit_type, entries=None):
+    junit_dir = os.path.dirname(JUNIT_XML_GEN)
+    # Make sure the qaset junit_xml_gen is the one imported
+    if sys.path[:1] != [junit_dir]:
+        sys.path.insert(0, junit_dir)
+    generate = None
+    try:
+        import junit_xml_gen
+        generate = getattr(junit_xml_gen, 'generate', None)
+        if generate is None:
+            logging.warning("No generate() in %s, running it instead" % (junit_xml_gen.__file__))
+    except ImportError, e:
+        logging.warning("Unable to import %s, running it instead: %s" % (JUNIT_XML_GEN, e))
+    if generate is None:
+        cmd = "%s %s -s %s -o %s -n '%s'" % (JUNIT_XML_GEN,
+                                            log_dir,
+                                            submission_dir,
+                                            junit_file,
+                                            junit_type)
+        subprocess.check_call(cmd, shell=True, stdin=None,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+        return
+    if not os.path.isdir(submission_dir):
+        logging.warning("No submission data. Not a directory: %s" % (submission_dir))
+        submission_dir = None
+    generate(junit_type, log_dir, [('xml', junit_file)],
+            submission_dir=submission_dir,
+            entries=entries,
+            logger=logging.getLogger('junit_xml_gen'))
+
 class PopenWithName(subprocess.Popen):
     def __init__(self, name, cmd):
         self.name = name
@@ -349,13 +390,10 @@ if __name__ == '__main__':
     # Running test
     runner = OpenqaRunner(args.script)
     runner.run()
+    # List logs once for uploading and junit
+    log_entries = glob.glob(os.path.join(args.log_dir, '*'))
     # Upload logs
-    upload_all_logs(args.log_dir, args.upload_url)
+    upload_all_logs(args.log_dir, args.upload_url, entries=log_entries)
     # Generate junit report
-    cmd = "/usr/share/qa/qaset/bin/junit_xml_gen.py %s -s %s -o %s -n '%s'" % (args.log_dir,
-                                                                            args.submission_dir,
-                                                                            args.junit_file,
-                                                                            args.junit_type)
-    subprocess.check_call(cmd, shell=True, stdin=None,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT)
+    generate_junit(args.log_dir, args.submission_dir, args.junit_file, args.junit_type,
+                    entries=log_entries)